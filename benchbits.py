@@ -0,0 +1,59 @@
+#Micro-benchmark for BitStreamer.getNextBits with long emote-heavy lines
+#Usage: python benchbits.py [module]
+#The module defaults to pptcontrol. Point it at an older copy to compare.
+
+import sys
+import time
+
+ChatLine = 'chatter:' + ' '.join(['PogChamp Kappa :) BibleThump o_O hype!!!'] * 6)
+RedLine = 'Show me your BibleThump ShiftPalette and spam PogChamp PogChamp'
+
+WordCount = 200000
+
+
+def timed(method, totals):
+    """Wrap a method so the time spent in it is added to totals[0]"""
+    def wrapper():
+        start = time.time()
+        method()
+        totals[0] += time.time() - start
+    return wrapper
+
+
+def bench(module, wordCount=WordCount):
+    """Return the average time in microseconds for one getNextBits call,
+       both in total and leaving out the time spent parsing new lines.
+    """
+    if hasattr(module, 'ChatBacklog'):
+        #Keep every line, the point is to time the encoder
+        bs = module.BitStreamer(chatBacklog=module.ChatBacklog(maxLag=None))
+    else:
+        bs = module.BitStreamer()
+    #Queue more than enough lines up front so only getNextBits is timed
+    for i in xrange(wordCount / 20):
+        bs.chatQueue.put(ChatLine)
+    for i in xrange(wordCount / 2000):
+        bs.redQueue.put(RedLine)
+
+    parseTime = [0.0]
+    bs.readChatQueue = timed(bs.readChatQueue, parseTime)
+    bs.readRedQueue = timed(bs.readRedQueue, parseTime)
+
+    getNextBits = bs.getNextBits
+    start = time.time()
+    for i in xrange(wordCount):
+        getNextBits()
+    total = time.time() - start
+    return total * 1e6 / wordCount, (total - parseTime[0]) * 1e6 / wordCount
+
+
+def main():
+    moduleName = sys.argv[1] if len(sys.argv) > 1 else 'pptcontrol'
+    module = __import__(moduleName)
+    results = [bench(module) for i in xrange(5)]
+    print '%s: %.2f us per getNextBits call, %.2f us without line parsing' % (
+        moduleName, min(r[0] for r in results), min(r[1] for r in results))
+
+
+if __name__ == '__main__':
+    main()
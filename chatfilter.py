@@ -0,0 +1,293 @@
+#Chat moderation for the IRC bots
+#Everything that decides whether a chat line may go to the replay, and in
+#what form, lives here so that theaxebot.py and themicrobot.py share one
+#implementation.
+
+import re
+import sys
+from collections import OrderedDict
+
+
+#Leet-speak expansions for each letter of a bad word.
+LeetSubstitutions = {
+    's': '[s5z2$]',
+    'z': '[s5z2$]',
+    'a': '[a4]',
+    'e': '[e3]',
+    'i': '[i1]',
+    'l': '[l1]',
+    'o': '[o0]',
+    't': '[t7]',
+    'g': '[g6]',
+    'b': '[b8]',
+    'f': '(?:f|ph)',
+    'c': '[ck]',
+    'k': '[ck]',
+}
+
+UrlPattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
+UrlLikePattern = r'\.(?:com|org|net)'
+#[18:12] <@Ilari> Also, one might want to drop character codes 0-31 and 127.
+NonPrintingPattern = r'[\x00-\x1f\x7f]'
+
+
+def readBadWords(filename):
+    """Read the bad word list, one word per line, as a sorted lower case list"""
+    with open(filename) as badWords:
+        words = set(word.strip().lower() for word in badWords)
+    words.discard('')
+    return sorted(words)
+
+
+def leetTokens(word):
+    """Split a bad word into one regex token per letter"""
+    return [LeetSubstitutions.get(c, re.escape(c)) for c in word]
+
+
+def makeBadWordPattern(word):
+    """
+    Expand a bad word into a regex that also catches common leet spellings.
+
+    >>> makeBadWordPattern('fool')
+    '(?:f|ph)[o0][o0][l1]'
+    """
+    return ''.join(leetTokens(word))
+
+
+def makeBadWordTriePattern(words):
+    """
+    Build one regex for all the bad words with common prefixes shared, so
+    the regex engine only tries the words that can match at each position.
+    A word that is a prefix of another makes the longer one redundant.
+
+    >>> makeBadWordTriePattern(['ass', 'asshat', 'anal', 'xy'])
+    '(?:[a4](?:[s5z2$][s5z2$]|n[a4][l1])|xy)'
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for token in leetTokens(word):
+            node = node.setdefault(token, {})
+        node[''] = {}
+
+    def nodePattern(node):
+        if '' in node:
+            return ''
+        alternatives = [token + nodePattern(child) for token, child in sorted(node.items())]
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return '(?:' + '|'.join(alternatives) + ')'
+
+    return nodePattern(trie)
+
+
+class ChatFilter(object):
+    """Checks chat lines against every moderation rule in one regex scan.
+       The url, url-like, non-printing and bad word rules are compiled into
+       a single regex, with the bad words merged into a prefix trie. Only
+       when a line is rejected do we go back to work out which bad word it
+       was.
+
+    >>> f = ChatFilter(['fool', 'bar'])
+    >>> f.check('blue:hello world') is None
+    True
+    >>> f.check('blue:go to http://example.com')
+    'url'
+    >>> f.check('blue:example.NET')
+    'url-like'
+    >>> f.check('blue:bell\\x07')
+    'non-printing chars'
+    >>> f.check('blue:what a PH00L')
+    'bad word: (?:f|ph)[o0][o0][l1]'
+    >>> f.check('blue:8ar')
+    'bad word: [b8][a4]r'
+    """
+    def __init__(self, badWords):
+        self.badWordPatterns = [makeBadWordPattern(word) for word in badWords]
+        self.badWords = [re.compile(pattern) for pattern in self.badWordPatterns]
+
+        #Python 2 only allows 100 groups so only the rule kinds get a group.
+        rules = [
+            ('url', UrlPattern),
+            ('urllike', UrlLikePattern),
+            ('nonprinting', NonPrintingPattern),
+        ]
+        if self.badWordPatterns:
+            rules.append(('badword', makeBadWordTriePattern(badWords)))
+        self.combinedRegex = re.compile('|'.join(
+            '(?P<%s>%s)' % (name, pattern) for name, pattern in rules))
+
+    def check(self, text):
+        """Return the reason this line should be rejected, or None if it is fine"""
+        text_lower = text.lower()
+        m = self.combinedRegex.search(text_lower)
+        if m is None:
+            return None
+        if m.lastgroup == 'url':
+            return 'url'
+        if m.lastgroup == 'urllike':
+            return 'url-like'
+        if m.lastgroup == 'nonprinting':
+            return 'non-printing chars'
+        #Work out which of the words matched here
+        for badword_regex in self.badWords:
+            if badword_regex.match(text_lower, m.start()):
+                return 'bad word: ' + badword_regex.pattern
+        return 'bad word'
+
+
+def normalizeChat(text):
+    """
+    The key for spotting near-identical lines. Case, punctuation, spacing
+    and the same word over and over don't count.
+
+    >>> normalizeChat('PogChamp  PogChamp pogchamp!!')
+    'pogchamp'
+    >>> normalizeChat('gg wp') == normalizeChat('GG, WP!')
+    True
+    >>> normalizeChat(' :) ')
+    ':)'
+    """
+    words = []
+    for word in re.findall(r'\w+', text.lower()):
+        if not words or words[-1] != word:
+            words.append(word)
+    if not words:
+        #Nothing but punctuation, like a smiley
+        return text.strip().lower()
+    return ' '.join(words)
+
+
+class SpamCollapser(object):
+    """
+    Collapses repeats of a chat line within a time window. The first line
+    goes out right away. Repeats from anyone within window seconds are
+    counted, and when the window closes one line with the number of repeats
+    goes out instead of all of them. The count leaves out the first line,
+    since that was already sent, and is credited to whoever repeated it: the
+    first of them, plus how many others there were. A single repeat is cheaper
+    to send as it is than as a count, so it goes out unchanged. At most
+    maxKeys lines are remembered; when there are more, the oldest window is
+    closed early.
+
+    Windows close on the next call to add or flush, so call flush now and
+    then for the counts to go out when chat is quiet.
+
+    >>> spam = SpamCollapser(window=10)
+    >>> spam.add('amy:PogChamp', 0)
+    ['amy:PogChamp']
+    >>> spam.add('bob:pogchamp POGCHAMP', 1), spam.add('cat:PogChamp!', 2)
+    ([], [])
+    >>> spam.add('dan:hello', 5)
+    ['dan:hello']
+    >>> spam.flush(11)
+    ['bob+1:PogChamp x2']
+    >>> spam.add('eve:PogChamp', 16)
+    ['eve:PogChamp']
+    >>> spam.add('eve:PogChamp', 17), spam.add('eve:PogChamp', 18)
+    ([], [])
+    >>> spam.add('amy:gg', 26), spam.add('bob:GG', 27)
+    (['eve:PogChamp x2', 'amy:gg'], [])
+    >>> spam.flush(36)
+    ['bob:GG']
+    """
+    def __init__(self, window=10.0, maxKeys=4096):
+        self.window = window
+        self.maxKeys = maxKeys
+        #Normalized text -> [time, first line, repeats, first repeat,
+        #nicks that repeated it], oldest first
+        self.recent = OrderedDict()
+
+    def add(self, line, now):
+        """Take a nick:text chat line. Returns the lines to send now: any
+           counts for windows that have closed, then the line itself unless
+           it is a repeat.
+        """
+        lines = self.flush(now)
+        nick, text = line.split(':', 1)
+        key = normalizeChat(text)
+        entry = self.recent.get(key)
+        if entry is not None:
+            entry[2] += 1
+            if entry[3] is None:
+                entry[3] = line
+            entry[4].add(nick)
+            return lines
+
+        self.recent[key] = [now, line, 0, None, set()]
+        if len(self.recent) > self.maxKeys:
+            lines.extend(self.summary(self.recent.popitem(last=False)[1]))
+        lines.append(line)
+        return lines
+
+    def flush(self, now):
+        """Close the windows that are over, returning the counts to send"""
+        lines = []
+        while self.recent:
+            key = next(iter(self.recent))
+            entry = self.recent[key]
+            if now - entry[0] < self.window:
+                break
+            del self.recent[key]
+            lines.extend(self.summary(entry))
+        return lines
+
+    def summary(self, entry):
+        when, line, repeats, firstRepeat, nicks = entry
+        if repeats < 2:
+            return [firstRepeat] if repeats else []
+        nick = firstRepeat.split(':', 1)[0]
+        if len(nicks) > 1:
+            nick += '+%d' % (len(nicks) - 1)
+        return ['%s:%s x%d' % (nick, line.split(':', 1)[1], repeats)]
+
+
+class RateLimiter(object):
+    """
+    A token bucket per nick. Each nick may post burst lines at once and then
+    rate lines a second, so one fast typist can't take the chat away from
+    everyone else. Only the maxUsers most recently seen nicks have a bucket;
+    a nick that was dropped starts again with a full one.
+
+    >>> limiter = RateLimiter(rate=0.5, burst=2)
+    >>> [limiter.allow('amy', 0) for _ in range(3)]
+    [True, True, False]
+    >>> limiter.allow('bob', 0), limiter.allow('amy', 1), limiter.allow('amy', 2)
+    (True, False, True)
+    >>> limiter = RateLimiter(rate=0.5, burst=1, maxUsers=2)
+    >>> limiter.allow('amy', 0), limiter.allow('bob', 0), limiter.allow('cat', 0)
+    (True, True, True)
+    >>> limiter.allow('bob', 0), limiter.allow('amy', 0)
+    (False, True)
+    """
+    def __init__(self, rate=0.2, burst=3, maxUsers=10000):
+        self.rate = rate
+        self.burst = burst
+        self.maxUsers = maxUsers
+        #Nick -> [tokens, time of last update], least recently seen first
+        self.buckets = OrderedDict()
+
+    def allow(self, nick, now):
+        """Take a token from nick's bucket. False if there are none left."""
+        bucket = self.buckets.pop(nick, None)
+        if bucket is None:
+            bucket = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        #Put it back at the most recent end
+        self.buckets[nick] = bucket
+        if len(self.buckets) > self.maxUsers:
+            self.buckets.popitem(last=False)
+
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+
+if __name__ == '__main__':
+    if '--test' in sys.argv:
+        import doctest
+        res = doctest.testmod()
+        sys.exit(1 if res.failed else 0)
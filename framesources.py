@@ -0,0 +1,98 @@
+#Frame sources for the replay engine in replay_switch.py
+#A source hands out one frame at a time as 8 uint32 slots, in the order the
+#replay device packets use them, or None when it has nothing more to play.
+
+import os
+from array import array
+
+from moviereader import openMovie
+
+
+class MovieSource(object):
+    """Frames from a movie file"""
+
+    def __init__(self, filename, skip=0):
+        _, ftype = os.path.splitext(filename)
+        self.movie = openMovie(filename)
+        self.isFm2 = ftype == '.fm2'
+        self.skip = skip
+        #No multitap packets for nes, less comms = less problems
+        self.packetStride = 4 if ftype == '.r08' else 2
+
+    def rewind(self):
+        if self.isFm2:
+            #The first input line is never sent; play starts after it and
+            #the skipped ones
+            self.movie.seek(self.skip + 1)
+        else:
+            #.rXX does not support skipping
+            self.movie.seek(0)
+
+    def lagFrame(self):
+        """The console lagged. An fm2 has an input line for that, so skip it."""
+        if self.isFm2:
+            self.movie.skipFrame()
+
+    def nextFrame(self):
+        return self.movie.nextFrame()
+
+
+class ChatSource(object):
+    """Frames of chat and Red's text from a BitStreamer, four words a frame"""
+
+    packetStride = 2
+
+    def __init__(self, bitStreamer):
+        self.bitStreamer = bitStreamer
+        self.frame = array('I', [0] * 8)
+
+    def rewind(self):
+        pass
+
+    def lagFrame(self):
+        pass
+
+    def nextFrame(self):
+        w = self.bitStreamer.getNextBitsBatch(4)
+        #The device wants the low byte of each word first
+        w.byteswap()
+
+        frame = self.frame
+        frame[0] = w[0] << 16
+        frame[4] = w[1] << 16
+        frame[1] = w[2] << 16
+        frame[5] = w[3] << 16
+        return frame
+
+
+class SwitchSource(object):
+    """Frames from one source until switchAt frames have been sent since
+       the last rewind, then from another.
+    """
+
+    def __init__(self, first, second, switchAt):
+        self.first = first
+        self.second = second
+        self.switchAt = switchAt
+        self.rewind()
+
+    def rewind(self):
+        self.first.rewind()
+        self.second.rewind()
+        self.current = self.first
+        self.sent = 0
+
+    @property
+    def packetStride(self):
+        return self.current.packetStride
+
+    def lagFrame(self):
+        self.current.lagFrame()
+
+    def nextFrame(self):
+        if self.sent == self.switchAt:
+            self.current = self.second
+        frame = self.current.nextFrame()
+        if frame is not None:
+            self.sent += 1
+        return frame
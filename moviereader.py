@@ -0,0 +1,230 @@
+#Movie file readers for the replay scripts
+#Every format is decoded into the same frame: 8 uint32 slots, one per
+#controller data line, in the order the replay device packets use them.
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+
+#Per raw format: struct for one frame, the slots it fills and how far each
+#value is shifted up to be MSB aligned in its slot.
+RawFormats = {
+    '.r08': (struct.Struct('>2B'), (0, 4), 24),
+    '.r16': (struct.Struct('>2H'), (0, 4), 16),
+    '.r16m': (struct.Struct('>8H'), (0, 1, 2, 3, 4, 5, 6, 7), 16),
+    '.r32': (struct.Struct('>2I'), (0, 4), 0),
+}
+
+class RawMovie(object):
+    """A .rXX movie, memory mapped and decoded one frame at a time"""
+
+    def __init__(self, filename, ftype):
+        self.frameStruct, self.slots, self.shift = RawFormats[ftype]
+        self.frame = array('I', [0] * 8)
+        self.pos = 0
+
+        with open(filename, 'rb') as movieFile:
+            size = os.fstat(movieFile.fileno()).st_size
+            if size:
+                self.data = mmap.mmap(movieFile.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                #mmap can't map an empty file
+                self.data = ''
+        self.frameCount = size // self.frameStruct.size
+
+    def seek(self, frame):
+        self.pos = frame
+
+    def skipFrame(self):
+        self.pos += 1
+
+    def nextFrame(self):
+        """The next frame, or None at the end of the movie.
+           The same array is reused for every frame.
+        """
+        if self.pos >= self.frameCount:
+            return None
+        values = self.frameStruct.unpack_from(self.data, self.pos * self.frameStruct.size)
+        self.pos += 1
+
+        frame = self.frame
+        shift = self.shift
+        for slot, value in zip(self.slots, values):
+            frame[slot] = value << shift
+        return frame
+
+
+def parseFm2Line(line):
+    """
+    Player 1 and 2 buttons from an fm2 input line, one bit per button in
+    RLDUTSBA order starting from bit 0.
+
+    >>> parseFm2Line('|0|R......A|........||')
+    (129, 0)
+    >>> parseFm2Line('|0|.L.U....|||')
+    (10, 0)
+    """
+    data = line.split('|')
+    p1 = 0
+    p2 = 0
+    for x in xrange(8):
+        if data[2][x] != '.':
+            p1 |= 1 << x
+        if len(data[3]) and data[3][x] != '.':
+            p2 |= 1 << x
+    return p1, p2
+
+
+def parseFm2(data):
+    """
+    Parse the text of an fm2 file into an array with two uint32 words,
+    player 1 then player 2 MSB aligned, per input line. Also returns the
+    line number of the first input line.
+
+    >>> words, firstLine = parseFm2('version 3\\n|0|R.......|||\\n|0|.......A|R.......||\\n')
+    >>> [int(w >> 24) for w in words], firstLine
+    ([1, 0, 128, 1], 2)
+    """
+    words = array('I')
+    firstLine = 0
+    for lineNumber, line in enumerate(data.splitlines(), 1):
+        if not line.startswith('|'):
+            if firstLine:
+                #Input is over at the first line that isn't input
+                break
+            continue
+        if not firstLine:
+            firstLine = lineNumber
+        p1, p2 = parseFm2Line(line)
+        words.append(p1 << 24)
+        words.append(p2 << 24)
+    return words, firstLine
+
+
+#*************************
+#*  fm2 frame cache      *
+#*************************
+
+#Parsed fm2 files are kept next to the movie as <movie>.fm2.cache: a header
+#then the frame words, little-endian. The header has the sha1 of the fm2 it
+#came from, so an edited movie is parsed again.
+
+FM2_CACHE_VERSION = 1
+Fm2CacheHeader = struct.Struct('<4sH20sII')     # magic, version, sha1, first line, frames
+
+
+def fm2CacheName(filename):
+    return filename + '.cache'
+
+
+def readFm2Cache(filename, digest):
+    """The cached words and first line for this fm2, or None if there is
+       no cache or it is for other contents.
+    """
+    try:
+        with open(fm2CacheName(filename), 'rb') as cacheFile:
+            header = cacheFile.read(Fm2CacheHeader.size)
+            if len(header) != Fm2CacheHeader.size:
+                return None
+            magic, version, cachedDigest, firstLine, frameCount = Fm2CacheHeader.unpack(header)
+            if magic != 'FM2C' or version != FM2_CACHE_VERSION or cachedDigest != digest:
+                return None
+            words = array('I')
+            words.fromfile(cacheFile, 2 * frameCount)
+    except (IOError, EOFError):
+        return None
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words, firstLine
+
+
+def writeFm2Cache(filename, digest, words, firstLine):
+    """Save the parsed frames. Not being able to is fine, we parse again next time."""
+    cacheName = fm2CacheName(filename)
+    tempName = '%s.%d' % (cacheName, os.getpid())
+    data = array('I', words)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    try:
+        with open(tempName, 'wb') as cacheFile:
+            cacheFile.write(Fm2CacheHeader.pack('FM2C', FM2_CACHE_VERSION, digest, firstLine, len(words) // 2))
+            data.tofile(cacheFile)
+        os.rename(tempName, cacheName)
+    except (IOError, OSError):
+        pass
+
+
+def loadFm2(filename):
+    """Frame words and first input line of an fm2, from the cache when it
+       matches the file, otherwise parsed and then cached.
+    """
+    with open(filename, 'rb') as movieFile:
+        data = movieFile.read()
+    digest = hashlib.sha1(data).digest()
+
+    cached = readFm2Cache(filename, digest)
+    if cached is not None:
+        return cached
+
+    words, firstLine = parseFm2(data)
+    writeFm2Cache(filename, digest, words, firstLine)
+    return words, firstLine
+
+
+class Fm2Movie(object):
+    """An fm2 movie, parsed once so a frame is just an index lookup"""
+
+    def __init__(self, filename):
+        self.words, self.firstLine = loadFm2(filename)
+        self.frame = array('I', [0] * 8)
+        self.frameCount = len(self.words) // 2
+        self.pos = 0
+
+    def seek(self, frame):
+        self.pos = frame
+
+    def skipFrame(self):
+        self.pos += 1
+
+    def nextFrame(self):
+        """The next frame, or None at the end of the movie.
+           The same array is reused for every frame.
+        """
+        if self.pos >= self.frameCount:
+            return None
+        self.frame[0] = self.words[2 * self.pos]
+        self.frame[4] = self.words[2 * self.pos + 1]
+        self.pos += 1
+        return self.frame
+
+
+def openMovie(filename):
+    """Open a movie file as a reader for its type, from the file extension"""
+    _, ftype = os.path.splitext(filename)
+    if ftype == '.fm2':
+        return Fm2Movie(filename)
+    if ftype in RawFormats:
+        return RawMovie(filename, ftype)
+    raise ValueError('Unknown movie type "%s"' % ftype)
+
+
+if __name__ == '__main__':
+    if '--test' in sys.argv:
+        import doctest
+        res = doctest.testmod()
+        sys.exit(1 if res.failed else 0)
+
+    if '--convert' in sys.argv:
+        #Build the frame cache for fm2 files ahead of time
+        for filename in sys.argv[sys.argv.index('--convert') + 1:]:
+            words, firstLine = loadFm2(filename)
+            print '%s: %d frames from line %d, cached in %s' % (
+                filename, len(words) // 2, firstLine, fm2CacheName(filename))
+        sys.exit(0)
+
+    sys.stderr.write('Usage: %s --test | --convert <movie.fm2>...\n' % sys.argv[0])
+    sys.exit(2)
@@ -2,9 +2,20 @@ import sys
 import os
 import time
 import re
-from threading import Thread
+import errno
+import select
+import hashlib
+import marshal
+import struct
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from threading import Thread, Lock
 from Queue import Queue
 
+from shmring import ShmRing
+
 
 def debug(msg):
     # print msg
@@ -65,12 +76,28 @@ LINE_LENGTH = 32  # Number of symbols per line.
 
 RED_COOLDOWN = 100  # Delay between RED's characters.
 
+SYMBOL_CACHE_SIZE = 1024  # Number of parsed lines of text to remember.
+
+CHAT_WORDS_PER_SECOND = 240  # Four words a frame at 60 frames a second.
+CHAT_MAX_LAG = 5.0  # Seconds of chat allowed to wait to be sent.
+
 #This is 10000000 0000000, 16 bits with just the high bit set
 HighBitSet = 2 ** 15
 
 #The 7-bit encoding for null character
 NullCharCode = 127
 
+#Kinds of record in the shared memory ring and the pipe, see lineRecord
+ChatRecordKind = 1
+RedRecordKind = 2
+#Reserved for commands to the replay. Skipped until there are some.
+CommandRecordKind = 3
+
+#Binary records on the replay pipe, see encodePipeRecord
+PIPE_RECORD_VERSION = 1
+#NUL, version, kind, receive time, symbol table digest, payload length
+PipeRecordHeader = struct.Struct('<cBBdIH')
+
 
 #************************
 #*  Character mappings  *
@@ -97,72 +124,82 @@ def makeFiveBitMap():
 FiveBitMapping = makeFiveBitMap()
 
 
-def makeEmoteMaps():
-    #These are simpler emotes. Tracked separately because the parsing is slightly different.
-    RobotEmoteList = [
-        ':)',
-        ':(',
-        ':o',
-        ':z',
-        'B)',
-        ':/',
-        ';)',
-        ';p',
-        ':p',
-        'R)',
-        'o_O',
-        ':D',
-        '>(',
-        '<3',
-    ]
+#These are simpler emotes. Tracked separately because the parsing is slightly different.
+RobotEmoteList = [
+    ':)',
+    ':(',
+    ':o',
+    ':z',
+    'B)',
+    ':/',
+    ';)',
+    ';p',
+    ':p',
+    'R)',
+    'o_O',
+    ':D',
+    '>(',
+    '<3',
+]
+
+#Face emotes that we have actually converted.
+#Other face emotes will be parsed but mapped to some other face.
+FaceEmoteList = [
+    'Kappa',
+    'FrankerZ',
+    'ResidentSleeper',
+    'FailFish',
+    'KreyGasm',
+    'PogChamp',
+    'SwiftRage',
+    'PJSalt',
+    'BibleThump',
+    'WinWaker',
+    'SomeFace',  # FIXME Placeholder
+]
+
+
+def makeRobotEmoteMap():
     #Mapping will be 0-13 in the order of this list
-    RobotEmoteMap = dict([(RobotEmoteList[i], i) for i in xrange(len(RobotEmoteList))])
-
-    #Face emotes that we have actually converted.
-    #Other face emotes will be parsed but mapped to some other face.
-    FaceEmoteList = [
-        'Kappa',
-        'FrankerZ',
-        'ResidentSleeper',
-        'FailFish',
-        'KreyGasm',
-        'PogChamp',
-        'SwiftRage',
-        'PJSalt',
-        'BibleThump',
-        'WinWaker',
-        'SomeFace',  # FIXME Placeholder
-    ]
+    return dict([(RobotEmoteList[i], i) for i in xrange(len(RobotEmoteList))])
+
+
+RobotEmoteMap = makeRobotEmoteMap()
+
+
+def makeFaceEmoteMap(emoteFileName):
     #Mapping will be 14-24 in the order of this list
     FaceEmoteMap = dict([(FaceEmoteList[i], i + len(RobotEmoteList)) for i in xrange(len(FaceEmoteList))])
 
     #Read all the emotes from a text file
-    with open('twitchemotes.txt') as twitchEmoteFile:
+    with open(emoteFileName) as twitchEmoteFile:
         allFaceEmotes = [emote.strip() for emote in twitchEmoteFile.readlines()]
     for emote in allFaceEmotes:
         if len(emote) > 0 and emote not in FaceEmoteMap:
             #This sets the default
             FaceEmoteMap[emote] = FaceEmoteMap['Kappa']
 
-    return RobotEmoteMap, FaceEmoteMap
+    return FaceEmoteMap
+
 
+# 0-96 in the order of this string, matching the font
+FontChars = list(
+    '\nabcdefghijklmno'
+    'pqrstuvwxyz ?!:.'
+    '"#$%&\\\'()*+,-./0'
+    '123456789;,=@ABC'
+    'DEFGHIJKLMNOPQRS'
+    'TUVWXYZ[\]^_`{|}'
+    '~'
+)
 
-RobotEmoteMap, FaceEmoteMap = makeEmoteMaps()
+#7-bit codes for the plain characters
+FontMapping = dict([(FontChars[i], i) for i in xrange(len(FontChars))])
 
 
-def makeSevenBitMapping():
+def makeSevenBitMapping(FaceEmoteMap):
     """Mapping for 7 bit chars, including emotes"""
-    # 0-96 in the order of this string, matching the font
-    legalChars = list(
-        '\nabcdefghijklmno'
-        'pqrstuvwxyz ?!:.'
-        '"#$%&\\\'()*+,-./0'
-        '123456789;,=@ABC'
-        'DEFGHIJKLMNOPQRS'
-        'TUVWXYZ[\]^_`{|}'
-        '~'
-    )
-    mapping = dict([(legalChars[i], i) for i in xrange(len(legalChars))])
+    mapping = dict(FontMapping)
 
     #Now add in emotes
     #Robot emotes have an index from 0-13. That gets mapped to 97-110 in this map.
@@ -175,20 +212,178 @@ def makeSevenBitMapping():
 
     return mapping
 
-SevenBitMapping = makeSevenBitMapping()
 
+#*************************
+#*  Lazy emote tables    *
+#*************************
+
+#The emote tables are built on first use rather than at import, and kept in
+#a cache file next to the emote list so a restart does not rebuild them.
+
+EMOTE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'twitchemotes.txt')
+SYMBOL_TABLE_CACHE = EMOTE_FILE + '.cache'
+
+#Bump this when the cached tables change shape
+SYMBOL_TABLE_VERSION = 1
+
+#These stay None until loadSymbolTables runs
+FaceEmoteMap = None
+SevenBitMapping = None
+SymbolCodes = None
+#Tells apart the SymbolCodes of two hosts, see symbolCodesDigest
+SymbolCodesDigest = None
+
+SymbolTableLock = Lock()
+
+
+def symbolTableKey():
+    """Identifies the tables the code would build, apart from the emote file"""
+    return hashlib.sha1(repr((SYMBOL_TABLE_VERSION, RobotEmoteList, FaceEmoteList, FontChars))).hexdigest()
+
+
+def hashFile(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def readSymbolTableCache(emoteStat):
+    """Return the cached tables if they were built from this emote file, or None"""
+    try:
+        with open(SYMBOL_TABLE_CACHE, 'rb') as cacheFile:
+            cached = marshal.load(cacheFile)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(cached, dict) or cached.get('key') != symbolTableKey():
+        return None
+    if cached['mtime'] == emoteStat.st_mtime and cached['size'] == emoteStat.st_size:
+        return cached
+    #The file was touched. It only matters if what is in it changed.
+    if cached['sha1'] != hashFile(EMOTE_FILE):
+        return None
+    writeSymbolTableCache(emoteStat, cached['sha1'], cached['faceEmotes'], cached['sevenBit'])
+    return cached
+
+
+def writeSymbolTableCache(emoteStat, sha1, faceEmotes, sevenBit):
+    """Save the tables. Not being able to is fine, we just build them next time."""
+    cached = {
+        'key': symbolTableKey(),
+        'mtime': emoteStat.st_mtime,
+        'size': emoteStat.st_size,
+        'sha1': sha1,
+        'faceEmotes': faceEmotes,
+        'sevenBit': sevenBit,
+    }
+    tempName = '%s.%d' % (SYMBOL_TABLE_CACHE, os.getpid())
+    try:
+        with open(tempName, 'wb') as cacheFile:
+            marshal.dump(cached, cacheFile)
+        os.rename(tempName, SYMBOL_TABLE_CACHE)
+    except (IOError, OSError):
+        debug('Could not write ' + SYMBOL_TABLE_CACHE)
+
+
+def loadSymbolTables():
+    """Set up FaceEmoteMap, SevenBitMapping and SymbolCodes if that has not
+       been done yet, from the cache file if it is still good.
+    """
+    global FaceEmoteMap, SevenBitMapping, SymbolCodes, SymbolCodesDigest
+    if SymbolCodes is not None:
+        return
+    with SymbolTableLock:
+        if SymbolCodes is not None:
+            return
+        emoteStat = os.stat(EMOTE_FILE)
+        cached = readSymbolTableCache(emoteStat)
+        if cached is not None:
+            faceEmotes = cached['faceEmotes']
+            sevenBit = cached['sevenBit']
+        else:
+            faceEmotes = makeFaceEmoteMap(EMOTE_FILE)
+            sevenBit = makeSevenBitMapping(faceEmotes)
+            writeSymbolTableCache(emoteStat, hashFile(EMOTE_FILE), faceEmotes, sevenBit)
+
+        codes = dict(sevenBit)
+        codes['ShiftPalette'] = ShiftPaletteCode
+
+        FaceEmoteMap = faceEmotes
+        SevenBitMapping = sevenBit
+        SymbolCodesDigest = zlib.crc32(repr(sorted(codes.items()))) & 0xFFFFFFFF
+        #Set last since it says everything is ready
+        SymbolCodes = codes
 
-# Here we compile a massive regex that captures all multi-character symbols.
-SYMBOLS = [r'\bShiftPalette\b']
-SYMBOLS += sorted((re.escape(e) for e in RobotEmoteMap), reverse=True)
-SYMBOLS += [r'\b{}\b'.format(re.escape(e)) for e in sorted(FaceEmoteMap, reverse=True)]
-SYMBOL_REGEX = re.compile('(' + '|'.join(SYMBOLS) + ')')
+
+def symbolCodesDigest():
+    """A checksum of the symbol codes, so codes made on another host can be
+       checked against ours before they are used.
+    """
+    if SymbolCodes is None:
+        loadSymbolTables()
+    return SymbolCodesDigest
+
+
+# This regex finds the places where a multi-character symbol could start:
+# ShiftPalette, a robot emote, or a whole word that might be a face emote.
+# Face emotes are looked up by word, so this does not grow with the emote list.
+TOKENS = [r'\b(?P<shift>ShiftPalette)\b']
+TOKENS += ['(?P<robot>' + '|'.join(sorted((re.escape(e) for e in RobotEmoteMap), reverse=True)) + ')']
+TOKENS += [r'\b(?P<word>\w+)']
+TOKEN_REGEX = re.compile('|'.join(TOKENS))
+
+
+class LruCache(object):
+    """A bounded cache that forgets the least recently used entry first.
+       Counts hits and misses so we can see how well it is doing.
+
+    >>> cache = LruCache(2)
+    >>> cache.put('a', 1); cache.put('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.info().items())
+    [('hits', 1), ('maxSize', 2), ('misses', 1), ('size', 2)]
+    """
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Look up a key, returning None if it is not cached"""
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            #Put it back at the most recently used end
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.entries), 'maxSize': self.maxSize}
+
+
+#Chat repeats itself a lot, so remember the symbols for recent lines of text
+SymbolCache = LruCache(SYMBOL_CACHE_SIZE)
 
 
 def textToSymbols(line):
     """
     Parse a line into list of symbols in our font, filtering out those which
-    cannot be displayed.
+    cannot be displayed. Recently seen lines come from SymbolCache.
 
     >>> textToSymbols('Kappa Kappa foo')
     ['Kappa', ' ', 'Kappa', ' ', 'f', 'o', 'o']
@@ -207,17 +402,47 @@ def textToSymbols(line):
     >>> textToSymbols('>>>Hello :)Kappa__ UnSane')
     ['H', 'e', 'l', 'l', 'o', ' ', ':)', 'K', 'a', 'p', 'p', 'a', '_', '_', ' ', 'UnSane']
     """
+    symbols = SymbolCache.get(line)
+    if symbols is None:
+        symbols = tuple(splitSymbols(line))
+        SymbolCache.put(line, symbols)
+    return list(symbols)
+
+
+def splitSymbols(line):
+    """Parse a line into symbols without using the cache"""
+    if SymbolCodes is None:
+        loadSymbolTables()
     symbols = []
-    for chunk in SYMBOL_REGEX.split(line):
-        if chunk in RobotEmoteMap or chunk in FaceEmoteMap or chunk == 'ShiftPalette':
-            symbols.append(chunk)
-        else:
-            for char in chunk:
-                if char in SevenBitMapping:
-                    symbols.append(char)
+    chunkStart = 0
+    pos = 0
+    search = TOKEN_REGEX.search
+    while True:
+        m = search(line, pos)
+        if m is None:
+            break
+        symbol = m.group(m.lastgroup)
+        if m.lastgroup == 'word' and symbol not in FaceEmoteMap:
+            #Not an emote. Robot emotes can still start inside the word.
+            pos = m.start() + 1
+            continue
+        addChunkSymbols(symbols, line[chunkStart:m.start()])
+        symbols.append(symbol)
+        chunkStart = pos = m.end()
+    addChunkSymbols(symbols, line[chunkStart:])
     return symbols
 
 
+def addChunkSymbols(symbols, chunk):
+    """Add the symbols for text between emotes, dropping what we can't display"""
+    if chunk in RobotEmoteMap or chunk in FaceEmoteMap or chunk == 'ShiftPalette':
+        symbols.append(chunk)
+    else:
+        for char in chunk:
+            if char in FontMapping:
+                symbols.append(char)
+
+
 def formatRoomMessage(message):
     r"""
     Format an IRC message from the chat room by converting it to the font's
@@ -239,7 +464,7 @@ def formatRoomMessage(message):
     # Full line should have nick:text. Need to split that up because nick does
     # not get emotes.
     nick, text = message.split(':', 1)
-    symbols = ([c for c in nick if c in SevenBitMapping] + [':', ' '] +
+    symbols = ([c for c in nick if c in FontMapping] + [':', ' '] +
                textToSymbols(text.rstrip('\n')))
     return symbols + ['\n']
     #This puts newlines for each line. Instead the snes side will handle this.
@@ -261,10 +486,12 @@ def padForRed(symbols):
     >>> padForRed(['a'] * 32) == ['a'] * 32
     True
     """
-    if len(symbols) % 28 == 0:
-        return symbols
+    return symbols + [' '] * redPadLength(len(symbols))
 
-    return symbols + [' '] * (28 - (len(symbols) % 28))
+
+def redPadLength(length):
+    """Number of spaces to pad a line for red of the given length"""
+    return -length % 28
 
 
 def encodeThreeChars(c1=None, c2=None, c3=None):
@@ -284,11 +511,13 @@ def encodeRedChar(redChar):
     """
     Encode a char for red's text as a 16-bit value.
     """
+    loadSymbolTables()
     return HighBitSet + SevenBitMapping.get(redChar, NullCharCode)
 
 
 def encodeChatChar(chatChar):
     """Encode a single chat char in ascii"""
+    loadSymbolTables()
     return HighBitSet + (SevenBitMapping.get(chatChar, NullCharCode) << 8)
 
 
@@ -296,6 +525,7 @@ def encodeTwoChars(chatChar=None, redChar=None):
     """Encode two characters, one for chat and one for Red.
        Both are optional.
     """
+    loadSymbolTables()
     return HighBitSet + (SevenBitMapping.get(chatChar, NullCharCode) << 8) + SevenBitMapping.get(redChar, NullCharCode)
     # return (SevenBitMapping.get(chatChar, NullCharCode) << 8) + SevenBitMapping.get(redChar, NullCharCode)
 
@@ -307,9 +537,449 @@ NopBits = 0xFFFF
 ShiftPaletteBits = 0b1111111111101110
 
 
+#****************************
+#*  Precomputed line codes  *
+#****************************
+
+#Lines are turned into arrays of 16-bit words when they come off the queue,
+#so getting the bits for a frame is just reading the next word.
+
+#Code for ShiftPalette in a line of codes. It is outside the 7-bit range.
+ShiftPaletteCode = 128
+
+#Marks codes that have no 5-bit form in FiveBitTable
+NotFiveBit = 255
+NotFiveBitChar = chr(NotFiveBit)
+
+
+def makeFiveBitTable():
+    """Translation table taking a 7-bit code to its 5-bit code, or NotFiveBit"""
+    table = bytearray([NotFiveBit] * 256)
+    for char, code in FontMapping.items():
+        if char in FiveBitMapping:
+            table[code] = FiveBitMapping[char]
+    return str(table)
+
+FiveBitTable = makeFiveBitTable()
+
+#Word sending just one chat char, for each code. ShiftPalette is sent as null.
+ChatCharWords = array('H', [HighBitSet | (min(code, NullCharCode) << 8) for code in xrange(256)])
+
+
+def symbolsToCodes(symbols):
+    """
+    Convert a list of symbols to a bytearray of codes. Symbols that are not
+    in the font become the null code.
+
+    >>> list(symbolsToCodes(['a', 'ShiftPalette', ':)', u'\xe9']))
+    [1, 128, 97, 127]
+    """
+    if SymbolCodes is None:
+        loadSymbolTables()
+    return bytearray([SymbolCodes.get(symbol, NullCharCode) for symbol in symbols])
+
+
+def encodeChatCodes(codes, start=0, end=None):
+    """
+    Pack chat codes from index start up to end into 16-bit words. Three chars
+    go in one word whenever the next three all have 5-bit codes, otherwise
+    one 7-bit char is sent. Returns the words and, for each word, the index
+    of its first code.
+
+    >>> words, starts = encodeChatCodes(symbolsToCodes('abc,de'))
+    >>> [decodeBits(w) for w in words] == [decodeBits(encodeThreeChars('a', 'b', 'c')),
+    ...     decodeBits(encodeChatChar(',')), decodeBits(encodeChatChar('d')),
+    ...     decodeBits(encodeChatChar('e'))]
+    True
+    >>> list(starts)
+    [0, 3, 4, 5]
+    """
+    fives = bytearray(str(codes).translate(FiveBitTable))
+    words = array('H')
+    starts = array('H')
+    addWord = words.append
+    addStart = starts.append
+    if end is None:
+        end = len(codes)
+    i = start
+    while i < end:
+        addStart(i)
+        if (i + 2 < end and fives[i] != NotFiveBit and
+                fives[i + 1] != NotFiveBit and fives[i + 2] != NotFiveBit):
+            addWord((fives[i] << 10) | (fives[i + 1] << 5) | fives[i + 2])
+            i += 3
+        else:
+            addWord(ChatCharWords[codes[i]])
+            i += 1
+    return words, starts
+
+
+def encodeRedCodes(codes):
+    """
+    Turn codes for one of Red's lines into 16-bit words. Each word carries
+    a null chat char, which can be swapped for a real one when sent.
+
+    >>> list(encodeRedCodes(symbolsToCodes(['ShiftPalette', 'b']))) == [
+    ...     ShiftPaletteBits, encodeRedChar('b')]
+    True
+    """
+    return array('H', [ShiftPaletteBits if code == ShiftPaletteCode else HighBitSet | code
+                       for code in codes])
+
+
+#Enough padding for any line, sliced off as needed instead of building lists
+RedPadWords = array('H', [HighBitSet | FontMapping[' ']]) * 28
+
+#For chatTextKey: what comes between the nick and the text, the codes to trim
+#and upper case codes turned to lower case
+ChatSeparatorCodes = bytearray([FontMapping[':'], FontMapping[' ']])
+ChatTrimCodes = chr(FontMapping[' ']) + chr(FontMapping['\n'])
+def makeCaseFoldTable():
+    """A str.translate table turning upper case codes into lower case"""
+    table = bytearray(xrange(256))
+    for upper in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
+        table[FontMapping[upper]] = FontMapping[upper.lower()]
+    return str(table)
+
+CaseFoldTable = makeCaseFoldTable()
+
+
+def chatTextKey(codes):
+    """
+    What a chat line's codes say, for spotting duplicates: the codes after
+    the nick, in lower case and without spaces or a newline around them.
+
+    >>> key = chatTextKey(symbolsToCodes(formatRoomMessage('amy: Hello ')))
+    >>> key == chatTextKey(symbolsToCodes(formatRoomMessage('bob:hello')))
+    True
+    >>> key == chatTextKey(symbolsToCodes(formatRoomMessage('bob:hello!')))
+    False
+    """
+    start = codes.find(ChatSeparatorCodes)
+    text = str(codes[start + len(ChatSeparatorCodes):]) if start >= 0 else str(codes)
+    return text.translate(CaseFoldTable).strip(ChatTrimCodes)
+
+
+class PipeLineReader(object):
+    """Reads lines and binary records from a named pipe, see splitRecords.
+       It only wakes when there is data.
+       The pipe is opened non-blocking and waited on with select. When every
+       writer hangs up we reopen it, so select blocks again until the next
+       writer shows up instead of spinning on EOF.
+    """
+    def __init__(self, pipeName, chunkSize=65536):
+        if not os.path.exists(pipeName):
+            os.mkfifo(pipeName)
+        self.pipeName = pipeName
+        self.chunkSize = chunkSize
+        #Text after the last newline, waiting for the rest of its line
+        self.partial = ''
+        self.fd = None
+        self.open()
+
+    def open(self):
+        """Open the pipe. Non-blocking so this does not wait for a writer."""
+        self.fd = os.open(self.pipeName, os.O_RDONLY | os.O_NONBLOCK)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def readLines(self, timeout=None):
+        """Wait for data and return every complete line and record that has
+           arrived, lines without the newlines. Returns an empty list if the
+           timeout (in seconds, None to wait forever) runs out first.
+        """
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                return []
+            try:
+                chunk = os.read(self.fd, self.chunkSize)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            if chunk == '':
+                #All writers hung up. A last line without a newline is still
+                #a line, but half a record is no use.
+                self.close()
+                self.open()
+                if self.partial:
+                    line, self.partial = self.partial, ''
+                    if not line.startswith('\0'):
+                        return [line]
+                continue
+            lines, self.partial = splitRecords(self.partial + chunk)
+            if lines:
+                return lines
+
+
+class ChatBacklog(object):
+    """
+    The queue of chat lines waiting to be sent. It keeps the lag on screen
+    bounded: each line is costed in words when it is put, and once the
+    queued words would take longer than maxLag seconds to send at
+    wordsPerSecond, lines are dropped by policy:
+
+    'newest' - drop the line coming in
+    'oldest' - drop the oldest lines until the new one fits
+    'fair'   - drop the oldest line of whoever has the most words queued,
+               or the new line if that is its sender
+
+    Before the policy kicks in, a line whose text is already queued is
+    dropped as a duplicate, if collapseDuplicates is set. Lines are compared
+    by chatTextKey, whoever sent them and whether they came as text or
+    codes. Nothing is dropped while the backlog fits. maxLag of None never
+    drops. Lines go in and come out through put, get, empty and qsize like a
+    Queue.
+
+    >>> backlog = ChatBacklog(maxLag=0.1, wordsPerSecond=240, policy='fair')
+    >>> for line in ['spammer:PogChamp PogChamp', 'spammer:Kappa Kappa Kappa',
+    ...              'bob:hello there', 'spammer:PogChamp PogChamp', 'amy:hi']:
+    ...     backlog.put(line)
+    >>> [backlog.get() for i in xrange(backlog.qsize())]
+    ['spammer:Kappa Kappa Kappa', 'bob:hello there', 'amy:hi']
+    >>> sorted(backlog.stats()['dropped'].items())
+    [('duplicate', 1), ('fair', 1)]
+    """
+    def __init__(self, maxLag=CHAT_MAX_LAG, wordsPerSecond=CHAT_WORDS_PER_SECOND,
+                 policy='fair', collapseDuplicates=True):
+        if policy not in ('newest', 'oldest', 'fair'):
+            raise ValueError('Unknown chat drop policy: ' + policy)
+        self.maxWords = None if maxLag is None else int(maxLag * wordsPerSecond)
+        self.wordsPerSecond = wordsPerSecond
+        self.policy = policy
+        self.collapseDuplicates = collapseDuplicates
+
+        self.lock = Lock()
+        #(nick, text, line, words, (codes, chat words, starts)) for each
+        #queued line, oldest first
+        self.lines = deque()
+        self.words = 0
+        self.nickWords = {}
+        self.texts = {}
+
+        self.admitted = 0
+        self.dropped = {}
+        self.droppedWords = 0
+
+    def put(self, line):
+        """Queue a chat line, or drop it if there is no room"""
+        try:
+            codes = symbolsToCodes(formatRoomMessage(line))
+        except ValueError:
+            #No nick in it
+            with self.lock:
+                self.drop('malformed', 0)
+            return
+        self.admit(line.split(':', 1)[0], line, codes)
+
+    def putCodes(self, nick, codes):
+        """Queue a chat line that is already codes, see lineRecord. get
+           hands back the codes instead of a line.
+        """
+        self.admit(nick, codes, codes)
+
+    def admit(self, nick, line, codes):
+        """The line is packed into words here, to cost it, and kept that
+           way so it isn't packed again when it is sent. See getEncoded.
+        """
+        text = chatTextKey(codes)
+        chatWords, starts = encodeChatCodes(codes)
+        words = len(chatWords)
+        with self.lock:
+            if self.maxWords is not None and self.words + words > self.maxWords:
+                if self.collapseDuplicates and text in self.texts:
+                    self.drop('duplicate', words)
+                    return
+                if not self.makeRoom(nick, words):
+                    self.drop(self.policy, words)
+                    return
+            self.lines.append((nick, text, line, words, (codes, chatWords, starts)))
+            self.words += words
+            self.nickWords[nick] = self.nickWords.get(nick, 0) + words
+            self.texts[text] = self.texts.get(text, 0) + 1
+            self.admitted += 1
+
+    def makeRoom(self, nick, words):
+        """Drop queued lines by policy until words more fit. Returns False
+           if the new line should be dropped instead.
+        """
+        if self.policy == 'newest' or words > self.maxWords:
+            return False
+        while self.words + words > self.maxWords:
+            if self.policy == 'oldest':
+                index = 0
+            else:
+                biggest = max(self.nickWords, key=self.nickWords.get)
+                if self.nickWords[biggest] <= self.nickWords.get(nick, 0) + words:
+                    return False
+                index = [entry[0] for entry in self.lines].index(biggest)
+            entry = self.lines[index]
+            del self.lines[index]
+            self.remove(entry)
+            self.drop(self.policy, entry[3])
+        return True
+
+    def remove(self, entry):
+        nick, text, line, words, encoded = entry
+        self.words -= words
+        self.nickWords[nick] -= words
+        if not self.nickWords[nick]:
+            del self.nickWords[nick]
+        self.texts[text] -= 1
+        if not self.texts[text]:
+            del self.texts[text]
+
+    def drop(self, reason, words):
+        debug('dropped chat line: ' + reason)
+        self.dropped[reason] = self.dropped.get(reason, 0) + 1
+        self.droppedWords += words
+
+    def get(self):
+        """The oldest chat line. Check empty first."""
+        return self.getEntry()[2]
+
+    def getEncoded(self):
+        """The oldest chat line as its codes, chat words and the index of
+           each word's first code, see encodeChatCodes. Check empty first.
+        """
+        return self.getEntry()[4]
+
+    def getEntry(self):
+        with self.lock:
+            entry = self.lines.popleft()
+            self.remove(entry)
+            return entry
+
+    def empty(self):
+        return not self.lines
+
+    def qsize(self):
+        return len(self.lines)
+
+    def framesToDrain(self):
+        """Frames it will take to send everything queued, at four words a frame"""
+        return self.words / 4.0
+
+    def stats(self):
+        """Counts of lines let in and dropped by reason, and the backlog"""
+        with self.lock:
+            return {
+                'admitted': self.admitted,
+                'dropped': dict(self.dropped),
+                'droppedWords': self.droppedWords,
+                'queuedLines': len(self.lines),
+                'queuedWords': self.words,
+                'lagSeconds': float(self.words) / self.wordsPerSecond,
+            }
+
+
+def lineRecord(line):
+    """
+    A line as it would come down the pipe, turned into the kind and payload
+    of a ring record. Red's lines are just their codes. Chat lines are the
+    nick, a NUL, then the codes for the whole room message. Either way the
+    replay side has nothing left to parse.
+
+    >>> kind, payload = lineRecord('<red>:hi')
+    >>> kind == RedRecordKind, payload == symbolsToCodes(textToSymbols('hi'))
+    (True, True)
+    >>> kind, payload = lineRecord('bob:hi')
+    >>> kind == ChatRecordKind, payload[:4], payload[4:] == symbolsToCodes(formatRoomMessage('bob:hi'))
+    (True, bytearray(b'bob\\x00'), True)
+    """
+    if line.startswith('<red>'):
+        return RedRecordKind, symbolsToCodes(textToSymbols(line[len('<red>:'):]))
+    nick = line.split(':', 1)[0]
+    return ChatRecordKind, bytearray(nick + '\0') + symbolsToCodes(formatRoomMessage(line))
+
+
+def encodePipeRecord(line, timestamp):
+    """A line for the replay pipe as a binary record: a header then the
+       payload from lineRecord. The header starts with a NUL, which a text
+       line never does, so the two can be mixed on one pipe. It also has
+       the digest of our symbol codes, since the codes mean nothing to a
+       replay with other emote tables.
+    """
+    kind, payload = lineRecord(line)
+    return PipeRecordHeader.pack('\0', PIPE_RECORD_VERSION, kind, timestamp,
+                                 symbolCodesDigest(), len(payload)) + str(payload)
+
+
+Warned = set()
+
+def warnOnce(msg):
+    if msg not in Warned:
+        Warned.add(msg)
+        sys.stderr.write(msg + '\n')
+
+
+def splitRecords(data):
+    """
+    Split what has come down the pipe into text lines, without their
+    newlines, and binary records as (kind, timestamp, payload). Also returns
+    what is left over waiting for the rest of it. Records of another version
+    or made with other symbol codes are skipped, with a warning the first
+    time.
+
+    >>> record = encodePipeRecord('bob:hi', 5.0)
+    >>> items, rest = splitRecords('amy:yo\\n' + record + '<red>:hey\\nbob:')
+    >>> items[0], items[1][:2], items[1][2] == lineRecord('bob:hi')[1], items[2], rest
+    ('amy:yo', (1, 5.0), True, '<red>:hey', 'bob:')
+    >>> splitRecords(record[:-1]) == ([], record[:-1])
+    True
+    >>> otherTables = record[:11] + struct.pack('<I', symbolCodesDigest() ^ 1) + record[15:]
+    >>> splitRecords(otherTables)
+    ([], '')
+    """
+    if '\0' not in data:
+        lines = data.split('\n')
+        return lines, lines.pop()
+
+    items = []
+    pos = 0
+    while pos < len(data):
+        if data[pos] == '\0':
+            if len(data) - pos < PipeRecordHeader.size:
+                break
+            nul, version, kind, timestamp, digest, length = PipeRecordHeader.unpack_from(data, pos)
+            start = pos + PipeRecordHeader.size
+            if start + length > len(data):
+                break
+            if version != PIPE_RECORD_VERSION:
+                warnOnce('Skipping pipe records of version %d' % version)
+            elif digest != symbolCodesDigest():
+                warnOnce('Skipping pipe records made with other emote tables')
+            else:
+                items.append((kind, timestamp, bytearray(buffer(data, start, length))))
+            pos = start + length
+        else:
+            end = data.find('\n', pos)
+            if end < 0:
+                break
+            items.append(data[pos:end])
+            pos = end + 1
+    return items, data[pos:]
+
+
+def queueRecord(chatQueue, redQueue, kind, payload):
+    """Put the codes from a record on the right queue, see lineRecord"""
+    if kind == RedRecordKind:
+        redQueue.put(payload)
+    elif kind == ChatRecordKind:
+        nickEnd = payload.index('\0')
+        chatQueue.putCodes(str(payload[:nickEnd]), payload[nickEnd + 1:])
+    else:
+        debug('skipped record of kind %d' % kind)
+
+
 class TextPipeHandler(Thread):
     """Reads the input from the replay pipe and adds to the line queues.
-       Decides when to drop chat if it gets too backed up.
+       The chat queue decides when to drop chat if it gets too backed up,
+       see ChatBacklog.
     """
     def __init__(self, chatQueue, redQueue, pipeName):
         super(TextPipeHandler, self).__init__()
@@ -317,37 +987,137 @@ class TextPipeHandler(Thread):
         self.chatQueue = chatQueue
         self.redQueue = redQueue
 
-        if not os.path.exists(pipeName):
-            os.mkfifo(pipeName)
-        self.readPipe = open(pipeName, 'r')
-
-    def readNextLine(self):
-        """Read the next line, halting everything until something comes"""
-        while True:
-            line = self.readPipe.readline()
-            #If we read from flushed pipe then wait a moment before moving on
-            if line == '':
-                time.sleep(0.1)
-                continue
-            return line.rstrip('\n')
+        self.reader = PipeLineReader(pipeName)
+
+    def handleLine(self, line):
+        """Add a line or record from the pipe to the appropriate queue"""
+        if isinstance(line, tuple):
+            kind, timestamp, payload = line
+            debug('record of kind %d from %.3f seconds ago' % (kind, time.time() - timestamp))
+            queueRecord(self.chatQueue, self.redQueue, kind, payload)
+        elif line.startswith('<red>'):
+            debug('line for Red: ' + line)
+            self.redQueue.put(line[len('<red>:'):])
+        else:
+            debug('chat line: ' + line)
+            self.chatQueue.put(line)
 
     def run(self):
         """Listen on the pipe. On reading something add it to the appropriate queue"""
         while True:
-            line = self.readNextLine()
-            if line.startswith('<red>'):
-                debug('line for Red: ' + line)
-                self.redQueue.put(line[len('<red>:'):])
-            #Check the number of chat lines queued up. Drop this one if there are too many.
-            elif self.chatQueue.qsize() < 20:
-                debug('chat line: ' + line)
-                self.chatQueue.put(line)
+            for line in self.reader.readLines():
+                self.handleLine(line)
+
+
+#*************************
+#*  Schedulers           *
+#*************************
+
+class CooldownScheduler(object):
+    """Decides how Red and chat share the words. Red types one char and then
+       waits cooldown words, and a chat char rides along with Red's char
+       whenever chat has one.
+    """
+    def __init__(self, cooldown=RED_COOLDOWN):
+        self.cooldown = cooldown
+
+    def startRedLine(self, redWords):
+        """Red has a new line of words to send"""
+        pass
+
+    def nextRedCooldown(self, streamer):
+        """Red just sent a char. Return how many words to wait for the next."""
+        return self.cooldown
+
+    def pairChat(self, streamer):
+        """Whether Red's char should carry the next chat char"""
+        return True
+
+
+class PackingScheduler(CooldownScheduler):
+    """
+    Like CooldownScheduler, but only takes a chat char for Red's word when
+    that saves a word: taking one char from a run of 5-bit chars whose
+    length is a multiple of three breaks up a triple and costs a word.
+    Red's word then carries a null chat char. Nothing is reordered.
+
+    >>> def wordsForChat(scheduler):
+    ...     bs = BitStreamer(scheduler=scheduler)
+    ...     for i in xrange(10):
+    ...         bs.chatQueue.put('bob:gg PogChamp what is this')
+    ...         bs.chatQueue.put('al:hype Kappa lol')
+    ...         bs.redQueue.put('hello')
+    ...     while not (bs.chatQueue.empty() and bs.chatPos == len(bs.chatWords)):
+    ...         w = bs.getNextBits()
+    ...     return bs.stats()['words']
+    >>> wordsForChat(CooldownScheduler(cooldown=3)), wordsForChat(PackingScheduler(cooldown=3))
+    (200, 187)
+
+    With redDeadline, Red is sped up as needed to send each line within
+    that many words.
+
+    >>> s = PackingScheduler(cooldown=100, redDeadline=50)
+    >>> s.startRedLine(encodeRedCodes(symbolsToCodes(list('hello'))))
+    >>> [s.nextRedCooldown(BitStreamer()) for i in xrange(5)]
+    [11, 11, 12, 12, 100]
+
+    chatWeight shares the words fairly while chat is waiting: Red's chars
+    are then at least chatWeight words apart, so chat gets chatWeight words
+    for each of Red's even when a deadline is pushing Red. It never slows
+    Red down past cooldown.
+
+    >>> busy = BitStreamer()
+    >>> busy.chatQueue.put('bob:hi')
+    >>> for weight in (0, 3):
+    ...     s = PackingScheduler(cooldown=100, redDeadline=10, chatWeight=weight)
+    ...     s.startRedLine(encodeRedCodes(symbolsToCodes(list('hello'))))
+    ...     print [s.nextRedCooldown(busy) for i in xrange(5)]
+    [1, 1, 2, 2, 100]
+    [3, 3, 3, 3, 100]
+    """
+    def __init__(self, cooldown=RED_COOLDOWN, redDeadline=None, chatWeight=0):
+        super(PackingScheduler, self).__init__(cooldown)
+        self.redDeadline = redDeadline
+        self.chatWeight = chatWeight
+        self.redCharsLeft = 0
+        self.redWordsLeft = 0
+
+    def startRedLine(self, redWords):
+        self.redCharsLeft = len(redWords) - redWords.count(ShiftPaletteBits)
+        self.redWordsLeft = self.redDeadline
+
+    def nextRedCooldown(self, streamer):
+        cooldown = self.cooldown
+        onDeadline = False
+        if self.redDeadline is not None:
+            self.redCharsLeft -= 1
+            if self.redCharsLeft > 0:
+                #Spread the rest of the line over the words left
+                spacing = max(self.redWordsLeft, 0) // self.redCharsLeft - 1
+                cooldown = max(0, min(self.cooldown, spacing))
+                onDeadline = True
+        if streamer.chatPos < len(streamer.chatWords) or not streamer.chatQueue.empty():
+            #Chat is waiting, so Red only gets its share
+            cooldown = max(cooldown, min(self.chatWeight, self.cooldown))
+        if onDeadline:
+            self.redWordsLeft -= cooldown + 1
+        return cooldown
+
+    def pairChat(self, streamer):
+        #A char that isn't 5-bit always has a word to itself
+        run = streamer.chatRunLength()
+        return run == 0 or run % 3 != 0
 
 
 class BitStreamer(object):
-    """Manages the stream of commands to send"""
-    def __init__(self, pipeName=None):
-        self.chatQueue = Queue()
+    """Manages the stream of commands to send.
+       A scheduler decides how Red's chars and chat share the words, see
+       CooldownScheduler.
+    """
+    def __init__(self, pipeName=None, scheduler=None, chatBacklog=None, ringName=None):
+        if chatBacklog is None:
+            chatBacklog = ChatBacklog()
+        self.chatQueue = chatBacklog
         self.redQueue = Queue()
 
         #If we got a pipe name then start the pipe handler thread
@@ -356,79 +1126,152 @@ class BitStreamer(object):
             pipeThread = TextPipeHandler(self.chatQueue, self.redQueue, pipeName)
             pipeThread.start()
 
-        #Translate next line into a list of chars or emotes to send
-        self.chatChars = []
-        self.redChars = []
+        #Lines can also come through a shared memory ring, already as codes.
+        #It is read whenever a queue runs dry, see readRing.
+        self.ring = None
+        if ringName is not None:
+            self.ring = ShmRing(ringName, create=True)
+
+        #The current lines as codes and ready-made words, with the index of
+        #the next word to send. See encodeChatCodes and encodeRedCodes.
+        self.chatCodes = bytearray()
+        self.chatFives = ''
+        self.chatWords = array('H')
+        self.chatStarts = array('H')
+        self.chatPos = 0
+        self.redWords = array('H')
+        self.redPos = 0
+
+        if scheduler is None:
+            scheduler = CooldownScheduler()
+        self.scheduler = scheduler
 
         #Number of inputs until another char from red
         self.redCooldown = 0
 
+        #What has been sent, see stats. Chat chars are counted a line at a
+        #time, the current line's from chatStarts.
+        self.sentWords = 0
+        self.nopWords = 0
+        self.commandWords = 0
+        self.pairedWords = 0
+        self.chatCharsDone = 0
+        self.redChars = 0
+
+    def readRing(self):
+        """Move the records waiting in the ring onto the queues"""
+        while True:
+            record = self.ring.get()
+            if record is None:
+                return
+            seq, kind, payload = record
+            queueRecord(self.chatQueue, self.redQueue, kind, payload)
+
     def readRedQueue(self):
         """Grab a line of red's text"""
         if self.redQueue.empty():
-            return
-        #Red's lines just have the text
-        text = self.redQueue.get().rstrip('\n')
-        # self.redChars = padForRed(textToSymbols(text)) + ['\n']
-        symbols = textToSymbols(text)
-        if (symbols[0] == "ShiftPalette"):
-            self.redChars = symbols
+            if self.ring is None or self.ring.empty():
+                return
+            self.readRing()
+            if self.redQueue.empty():
+                return
+        #Red's lines just have the text, or the codes if they came by ring
+        text = self.redQueue.get()
+        if isinstance(text, bytearray):
+            codes = text
         else:
-            self.redChars = padForRed(symbols)
-        debug("Parsed red line: " + str(self.redChars))
+            # symbols = padForRed(textToSymbols(text.rstrip('\n'))) + ['\n']
+            symbols = textToSymbols(text.rstrip('\n'))
+            debug("Parsed red line: " + str(symbols))
+            codes = symbolsToCodes(symbols)
+        self.redWords = encodeRedCodes(codes)
+        if not codes or codes[0] != ShiftPaletteCode:
+            self.redWords.extend(RedPadWords[:redPadLength(len(codes))])
+        self.redPos = 0
+        self.scheduler.startRedLine(self.redWords)
 
     def readChatQueue(self):
         """Grab a line of chat text"""
         if self.chatQueue.empty():
-            return
-        line = self.chatQueue.get()
-        self.chatChars = formatRoomMessage(line)
-        debug("Parsed chat line: " + str(self.chatChars))
+            if self.ring is None or self.ring.empty():
+                return
+            self.readRing()
+            if self.chatQueue.empty():
+                return
+        #The backlog packed the line into words when it came in
+        codes, words, starts = self.chatQueue.getEncoded()
+        self.chatCharsDone += len(self.chatCodes)
+        self.chatCodes = codes
+        self.chatFives = str(codes).translate(FiveBitTable)
+        self.chatWords = words
+        self.chatStarts = starts
+        self.chatPos = 0
+
+    def chatRunLength(self):
+        """Number of 5-bit chars from the next chat char on, 0 if that one
+           is not a 5-bit char.
+        """
+        first = self.chatStarts[self.chatPos]
+        runEnd = first
+        while runEnd < len(self.chatFives) and self.chatFives[runEnd] != NotFiveBitChar:
+            runEnd += 1
+        return runEnd - first
+
+    def chatWordEnd(self, pos):
+        """Index of the first code after the chat words before pos"""
+        if pos < len(self.chatStarts):
+            return self.chatStarts[pos]
+        return len(self.chatCodes)
+
+    def takeChatChar(self):
+        """Take just the next chat char, to send along with one of Red's.
+           The words for the rest of its run of 5-bit chars have to be
+           packed again. From the end of the run on they are unchanged.
+        """
+        first = self.chatStarts[self.chatPos]
+        runEnd = first + max(self.chatRunLength(), 1)
+        words, starts = encodeChatCodes(self.chatCodes, first + 1, runEnd)
+        nextWord = bisect_left(self.chatStarts, runEnd, self.chatPos)
+        self.chatWords[self.chatPos:nextWord] = words
+        self.chatStarts[self.chatPos:nextWord] = starts
+        return min(self.chatCodes[first], NullCharCode)
 
     def getBitsToSend(self):
         """Check our char queues and get the bits to send"""
 
         #First see if we have chars for red
-        if len(self.redChars) > 0:
-            if self.redChars[0] == 'ShiftPalette':
-                self.redChars.pop(0)
-                return ShiftPaletteBits
+        if self.redPos < len(self.redWords):
+            redWord = self.redWords[self.redPos]
+            if redWord == ShiftPaletteBits:
+                self.redPos += 1
+                self.commandWords += 1
+                return redWord
             if self.redCooldown == 0:
                 # Set cooldown - This is what slows down red's typing.
-                self.redCooldown = RED_COOLDOWN
-                if len(self.chatChars) == 0:
+                self.redCooldown = self.scheduler.nextRedCooldown(self)
+                self.redPos += 1
+                self.redChars += 1
+                if self.chatPos == len(self.chatWords):
                     #no chat char
-                    debug("One char for Red: %r" % (self.redChars[0],))
-                    return encodeRedChar(self.redChars.pop(0))
-                else:
+                    return redWord
+                elif self.scheduler.pairChat(self):
                     #include a chat char
-                    debug("Chat: %r Red: %r" % (self.chatChars[0], self.redChars[0],))
-                    return encodeTwoChars(
-                        self.chatChars.pop(0),
-                        self.redChars.pop(0))
+                    self.pairedWords += 1
+                    return redWord | (self.takeChatChar() << 8)
+                else:
+                    #chat goes on in the next word
+                    return redWord | (NullCharCode << 8)
             else:
                 self.redCooldown -= 1
 
-        # Chat chars only. Figure out how many of next chars are 5-bit
-        # encodable.  If all three of them then we use the compact
-        # format.
-        if (len(self.chatChars) >= 3 and
-                self.chatChars[0] in FiveBitMapping and
-                self.chatChars[1] in FiveBitMapping and
-                self.chatChars[2] in FiveBitMapping):
-            c1 = self.chatChars.pop(0)
-            c2 = self.chatChars.pop(0)
-            c3 = self.chatChars.pop(0)
-
-            debug("Three 5-bit chars: %r %r %r" % (c1, c2, c3))
-            return encodeThreeChars(c1, c2, c3)
-
-        #Send a chat char if one is available
-        if len(self.chatChars) > 0:
-            debug("One 7-bit char: %r" % (self.chatChars[0]))
-            return encodeChatChar(self.chatChars.pop(0))
+        #Chat words were packed when the line came off the queue
+        if self.chatPos < len(self.chatWords):
+            word = self.chatWords[self.chatPos]
+            self.chatPos += 1
+            return word
 
         #Default to no-op
+        self.nopWords += 1
         return NopBits
 
     def getNextBits(self):
@@ -437,20 +1280,155 @@ class BitStreamer(object):
         """
         #If we have no text from chat or red see if there is more
         #available in the Queue
-        if len(self.chatChars) == 0:
+        if self.chatPos == len(self.chatWords):
             self.readChatQueue()
-        if len(self.redChars) == 0:
+        if self.redPos == len(self.redWords):
             self.readRedQueue()
 
         #This is the stream that goes to replay
+        self.sentWords += 1
         return self.getBitsToSend()
 
+    def getNextBitsBatch(self, count):
+        """Get the next count words at once as an array('H'). The words are
+           the same as count calls to getNextBits would give. While Red is
+           quiet whole runs of chat words are copied in one go.
+        """
+        words = array('H')
+        while len(words) < count:
+            if self.chatPos == len(self.chatWords):
+                self.readChatQueue()
+            if self.redPos == len(self.redWords):
+                self.readRedQueue()
+
+            if self.redPos < len(self.redWords):
+                words.append(self.getBitsToSend())
+                continue
+
+            end = min(self.chatPos + count - len(words), len(self.chatWords))
+            if end == self.chatPos:
+                #Nothing left from chat or red
+                break
+            words.extend(self.chatWords[self.chatPos:end])
+            self.chatPos = end
+
+        if len(words) < count:
+            self.nopWords += count - len(words)
+            words.extend(array('H', [NopBits]) * (count - len(words)))
+        self.sentWords += count
+        return words
+
+    def stats(self):
+        """
+        Counts of what has been sent, and the chars per word that carried
+        anything.
+
+        >>> bs = BitStreamer()
+        >>> bs.chatQueue.put('bob:hi')
+        >>> words = bs.getNextBitsBatch(4)
+        >>> sorted(bs.stats().items())
+        [('charsPerWord', 2.0), ('chatChars', 8), ('commandWords', 0), ('nopWords', 0), ('pairedWords', 0), ('redChars', 0), ('words', 4)]
+        """
+        busyWords = self.sentWords - self.nopWords
+        chatChars = self.chatCharsDone + self.chatWordEnd(self.chatPos)
+        return {
+            'words': self.sentWords,
+            'nopWords': self.nopWords,
+            'commandWords': self.commandWords,
+            'pairedWords': self.pairedWords,
+            'chatChars': chatChars,
+            'redChars': self.redChars,
+            'charsPerWord': float(chatChars + self.redChars) / busyWords if busyWords else 0.0,
+        }
+
 
 def decodeBits(bits):
     """Debugging decode of 16 bits. Convert to binary string e.g. 00111011011010101010"""
     return format(bits, '#018b')[2:]
 
 
+#*******************
+#*  Bulk decoding  *
+#*******************
+
+#Names for the command opcodes we know about
+CommandNames = {
+    ShiftPaletteBits & 0x7f: 'ShiftPalette',
+}
+
+
+def encodeSymbols(symbols):
+    """Pack a whole list of chat symbols into an array('H') of words"""
+    return encodeChatCodes(symbolsToCodes(symbols))[0]
+
+
+def makeDecodeTables():
+    """Build tables giving the chat text, Red text and command opcode (or
+       None) carried by every possible 16-bit word.
+    """
+    fiveBitChars = [None] * 32
+    for char, code in FiveBitMapping.items():
+        fiveBitChars[code] = char
+    #7-bit codes back to symbols. Null is empty and unused codes are marked.
+    sevenBitSymbols = FontChars + RobotEmoteList + FaceEmoteList
+    sevenBitSymbols += ['<%d>' % code for code in xrange(len(sevenBitSymbols), 128)]
+    sevenBitSymbols[NullCharCode] = ''
+
+    triples = [a + b + c for a in fiveBitChars for b in fiveBitChars for c in fiveBitChars]
+    lowSymbols = sevenBitSymbols + [''] * 128
+    lowCommands = [None] * 128 + range(127) + [None]
+
+    chatTable = triples + [chat for chat in sevenBitSymbols for low in xrange(256)]
+    redTable = [''] * HighBitSet + lowSymbols * 128
+    commandTable = [None] * HighBitSet + lowCommands * 128
+    return chatTable, redTable, commandTable
+
+DecodeTables = None
+
+
+def decodeWords(words):
+    r"""
+    Decode a whole stream of 16-bit words. Returns the chat text, Red's text
+    and a list of (word index, command) for the commands in the stream.
+    Emotes come out as their names. A word with a char for just one of chat
+    or Red carries code 0 (newline) for the other, as encodeChatChar and
+    encodeRedChar send them.
+
+    >>> bs = BitStreamer()
+    >>> bs.chatQueue.put('blue:hello, Kappa')
+    >>> bs.redQueue.put('ShiftPalette hi')
+    >>> chat, red, commands = decodeWords(bs.getNextBitsBatch(40))
+    >>> chat
+    'blue: hello, Kappa\n'
+    >>> red.replace('\n', '')
+    ' '
+    >>> commands
+    [(0, 'ShiftPalette')]
+    >>> decodeWords(encodeRedCodes(symbolsToCodes(['h', 'i', ':)'])))
+    ('\n\n\n', 'hi:)', [])
+    """
+    global DecodeTables
+    if DecodeTables is None:
+        DecodeTables = makeDecodeTables()
+    chatTable, redTable, commandTable = DecodeTables
+
+    chat = ''.join(map(chatTable.__getitem__, words))
+    red = ''.join(map(redTable.__getitem__, words))
+    commands = [(i, CommandNames.get(op, op))
+                for i, op in enumerate(map(commandTable.__getitem__, words)) if op is not None]
+    return chat, red, commands
+
+
+def decodeStreamFile(filename):
+    """Decode a captured stream of little-endian 16-bit words"""
+    words = array('H')
+    with open(filename, 'rb') as streamFile:
+        words.fromstring(streamFile.read())
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return decodeWords(words)
+
+
 class BitStreamerTestThread(Thread):
     """Tests the BitStreamer by printing out its output"""
     def __init__(self, bs):
@@ -473,6 +1451,16 @@ def main():
         # print res
         sys.exit(1 if res.failed else 0)
 
+    if '--decode' in sys.argv:
+        #Print what a captured stream of words says
+        chat, red, commands = decodeStreamFile(sys.argv[sys.argv.index('--decode') + 1])
+        print 'Chat:'
+        print chat
+        print 'Red:'
+        print red
+        print '%d commands' % len(commands)
+        sys.exit(0)
+
     bs = BitStreamer('pipe_test')
     thread = BitStreamerTestThread(bs)
     thread.daemon = True
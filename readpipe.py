@@ -2,19 +2,20 @@
 #Created for testing the pipes for the IRC bot
 
 import sys
-import os
-import time
 
+from pptcontrol import (PipeLineReader, ChatRecordKind, RedRecordKind, decodeWords,
+                        encodeChatCodes, encodeRedCodes)
+
+
+def recordText(kind, payload):
+    """What a binary record from the pipe says, decoded from its codes"""
+    if kind == ChatRecordKind:
+        codes = payload[payload.index('\0') + 1:]
+        return decodeWords(encodeChatCodes(codes)[0])[0]
+    if kind == RedRecordKind:
+        return '<red>:' + decodeWords(encodeRedCodes(payload))[1]
+    return '<record of kind %d>' % kind
 
-def readNextLine(readPipe):
-    """Read the next line, halting everything until something comes"""
-    while True:
-        line = readPipe.readline()
-        #If we read from flushed pipe then wait a moment before moving on
-        if line == '':
-            time.sleep(0.1)
-            continue
-        return line.rstrip('\n')
 
 def main():
     if len(sys.argv) == 1:
@@ -22,18 +23,18 @@ def main():
     else:
         pipeName = sys.argv[1]
 
-    if not os.path.exists(pipeName):
-        os.mkfifo(pipeName)
-
-    readPipe = open(pipeName, 'r')
+    reader = PipeLineReader(pipeName)
 
     readCount = 0
     while True:
-        readCount += 1
-        line = readNextLine(readPipe)
-        print "%d: %s" % (readCount, line)
+        for line in reader.readLines():
+            readCount += 1
+            if isinstance(line, tuple):
+                kind, timestamp, payload = line
+                line = recordText(kind, payload)
+            print "%d: %s" % (readCount, line)
 
-    readPipe.close()
+    reader.close()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
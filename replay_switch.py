@@ -1,8 +1,14 @@
 import os
 import serial
+import struct
 import sys
 import time
 
+from array import array
+
+from framesources import MovieSource, ChatSource, SwitchSource
+from pptcontrol import BitStreamer, CooldownScheduler, PackingScheduler
+
 # for use on raspberry pi, please disable your serial console
 # a tool to do this automatically can be found at
 #
@@ -27,6 +33,13 @@ ubw_p2 = 0
 
 baud = 115200
 
+# seconds between redraws of the status line, 0 to never draw it (headless)
+status_interval = 0.1
+
+# seconds a read from the device waits before giving up; the main loop
+# sleeps in the read instead of polling inWaiting()
+serial_timeout = 1
+
 ####
 
 ver_max = ['1', '1']
@@ -36,19 +49,46 @@ prebuffer = 30
 ####
 
 framecount = [0, 0]
-firstline = 0
 totalframes = 0
 
 latches = '1'
 timeout = 0
 
-p = {}
-plog = []
+plog_frames = prebuffer + 2
+plog = array('I', [0]) * (8 * (plog_frames + 1))
+plog_head = 0
+plog_count = 0
+
+p = 0				# offset of the displayed frame in plog
+frames_shown = 0	# frames taken off plog since the last reset
 
 ####
 
+# options come out of argv first, the rest is positional
+def take_option(name, default):
+	if (name in sys.argv):
+		i = sys.argv.index(name)
+		value = sys.argv[i + 1]
+		del sys.argv[i:i + 2]
+		return value
+
+	return default
+
+chat_only = ('--chat' in sys.argv)
+if (chat_only):
+	sys.argv.remove('--chat')
+
+switch_at = int(take_option('--switch-at', '0'), 10)
+switch_latches = take_option('--switch-latches', '1')
+ring_name = take_option('--ring', None)
+scheduler_name = take_option('--scheduler', 'cooldown')
+red_deadline = take_option('--red-deadline', None)
+if (red_deadline is not None):
+	red_deadline = int(red_deadline, 10)
+chat_weight = int(take_option('--chat-weight', '0'), 10)
+
 if len(sys.argv) < 3:
-	sys.stderr.write('Usage: ' + sys.argv[0] + ' <replayfile> <interface> [skip] [latches] [timeout]\n\n')
+	sys.stderr.write('Usage: ' + sys.argv[0] + ' [--chat | --switch-at <frame> [--switch-latches <latches>]] <replayfile> <interface> [skip] [latches] [timeout]\n\n')
 	sys.stderr.write('<replayfile> can be of these types: \n' +
 		'    .fm2  (NES)\n' +
 		'    .r08  (8-bit p1 + p2 std frame only MSB)\n' +
@@ -60,16 +100,26 @@ if len(sys.argv) < 3:
 	sys.stderr.write("             1 = skip initial latch, 0 = normal   (r08)\n")
 	sys.stderr.write("[latches]    latches per frame (default 1, commonly 1 or 2)\n")
 	sys.stderr.write("[timeout]    amount of lag frames until reset is detected\n\n")
+	sys.stderr.write("--chat             stream chat from replay_pipe instead of the movie;\n")
+	sys.stderr.write("                   the movie still sets the controller modes\n")
+	sys.stderr.write("--switch-at        play this many movie frames, then stream chat\n")
+	sys.stderr.write("--switch-latches   latches per frame once chat reaches the console (default 1)\n")
+	sys.stderr.write("--ring             also take chat from this shared memory ring in /dev/shm\n")
+	sys.stderr.write("--scheduler        how Red and chat share the words: cooldown (default) or packing\n")
+	sys.stderr.write("--red-deadline     packing: send each of Red's lines within this many words\n")
+	sys.stderr.write("--chat-weight      packing: words chat gets for each of Red's while it waits (default 0)\n\n")
 	sys.exit(0)
 
+if (scheduler_name not in ('cooldown', 'packing')):
+	sys.stderr.write('Error: unknown scheduler "' + scheduler_name + '"\n')
+	sys.exit(1)
+
 if not os.path.exists(sys.argv[1]):
 	sys.stderr.write('Error: "' + sys.argv[1] + '" not found\n')
 	sys.exit(1)
 
 
-# open the file and get the extension
-fh = open(sys.argv[1], 'r')
-fb = ''
+# get the extension
 fm = []
 _, ftype = os.path.splitext(sys.argv[1])
 
@@ -92,6 +142,28 @@ if (len(sys.argv) >= 5):
 if (len(sys.argv) >= 6):
 	timeout = int(sys.argv[5], 10)
 
+# open the file, and the chat stream if we need it
+try:
+	movie_source = MovieSource(sys.argv[1], skip)
+except ValueError as e:
+	sys.stderr.write('Error: ' + str(e) + '\n')
+	sys.exit(1)
+movie = movie_source.movie
+
+if (chat_only or switch_at):
+	if (scheduler_name == 'packing'):
+		scheduler = PackingScheduler(redDeadline=red_deadline, chatWeight=chat_weight)
+	else:
+		scheduler = CooldownScheduler()
+	chat_source = ChatSource(BitStreamer('replay_pipe', scheduler=scheduler, ringName=ring_name))
+
+if (chat_only):
+	source = chat_source
+elif (switch_at):
+	source = SwitchSource(movie_source, chat_source, switch_at)
+else:
+	source = movie_source
+
 # if using ubw for gamepad display, configure it
 if (ubw_p1):
 	disp_p1 = serial.Serial(ubw_p1, 9600, timeout = 0)
@@ -110,7 +182,7 @@ if (ubw_p2):
 
 # get the firmware version - if it fails then we aren't connected...
 print("Looking for replay device...")
-ser = serial.Serial(sys.argv[2], baud, timeout = 1)
+ser = serial.Serial(sys.argv[2], baud, timeout = serial_timeout)
 ser.read()
 while (ser.inWaiting()):
 	ser.read() 					# clear out current receive buffer
@@ -121,10 +193,7 @@ time.sleep(0.03) 				# usb fix
 
 verr = 0
 while (1):
-	while (ser.inWaiting() == 0):
-		pass
-
-	ver = ser.read()
+	ver = ser.read()				# '' if the device said nothing in time
 
 	if (ver == 'V'):
 		ver = ser.read(3)
@@ -145,29 +214,14 @@ while (1):
 
 # final serial interface, on raspi use /dev/ttyAMA0 after disabling console
 ser.close()
-ser = serial.Serial(sys.argv[2], baud, timeout = 0)
+ser = serial.Serial(sys.argv[2], baud, timeout = serial_timeout)
 
 
 # file specific initial setup
 if (ftype == '.fm2'):
 	fm = '88'
 
-	# we need to determine which line is the first input line
-	# check all lines; when first character is a pipe, we have it
-	while (len(fb) == 0):
-		t = fh.readline()
-		firstline += 1
-		if (len(t)):
-			if (t[0] == '|'):
-				fb = t
-
-	print('File "' + sys.argv[1] + '" opened. FM2 input data stars at line ' + str(firstline) + '.')
-	
-	# get action count
-	totalframes = 1
-	for i, l in enumerate(fh):
-		if (t[0] == '|'):
-			totalframes += 1
+	print('File "' + sys.argv[1] + '" opened. FM2 input data stars at line ' + str(movie.firstLine) + '.')
 
 	if (skip):
 		print('Skipping ' + str(skip) + ' input actions.')
@@ -176,20 +230,8 @@ if (ftype[0:2] == '.r'):
 	fm.append(ftype[3])
 	fm.append(ftype[3])
 
-	stat = os.stat(sys.argv[1])
-
-	# get action count
-	if (ftype[3:4] == '8'):
-		totalframes = stat.st_size >> 1
-	if (ftype[3:4] == '6'):
-		if (ftype == '.r16m'):
-			totalframes = stat.st_size >> 4
-		else:
-			totalframes = stat.st_size >> 2
-	if (ftype[3:4] == '4'):
-		totalframes = stat.st_size >> 3
-	if (ftype[3:4] == '2'):
-		totalframes = stat.st_size >> 4
+# get action count
+totalframes = movie.frameCount
 
 
 if (latches):
@@ -213,26 +255,70 @@ if (prebuffer):
 		print('Frame stats below are ahead by ' + str(prebuffer + tskip + 1) + ' frames.')
 
 
+# controller log ring: frames sent to the device but not yet displayed.
+# each frame is 8 uint32 slots; frame 0 is never written and stays all
+# zero, for when there is nothing to show. the rest hold the prebuffer,
+# the frame just sent and the frame on display.
+def plog_push(b):
+	global plog_count
+
+	if (plog_count == plog_frames - 1):
+		plog_pop()		# never happens in play; keeps the newest frames
+
+	slot = 8 * (1 + (plog_head + plog_count) % plog_frames)
+	for x in range(0, 8):
+		plog[slot + x] = b[x]
+	plog_count += 1
+
+
+# shows the oldest logged frame, p becomes its offset in plog
+def plog_pop():
+	global p
+	global frames_shown
+	global plog_head
+	global plog_count
+
+	if (plog_count):
+		frames_shown += 1
+		p = 8 * (1 + plog_head)
+		plog_head = (plog_head + 1) % plog_frames
+		plog_count -= 1
+
+
+# forget everything logged, the device has dropped its buffer too
+def plog_clear():
+	global p
+	global plog_head
+	global plog_count
+	global frames_shown
+
+	p = 0
+	frames_shown = 0
+	plog_head = 0
+	plog_count = 0
+
+
 # all done... print out info, wait X frames, then tell the device to stop
 def cleanup():
 	global prebuffer
 	global framecount
-	global p
+
+	# anything still queued from a reset goes out first
+	flush_writes()
 
 	wait = prebuffer
 
 	while (wait):
-		while (ser.inWaiting() == 0):
-			pass
-		
-		ser.read()
+		if (not ser.read()):
+			continue
+
 		wait -= 1
 		
 		# update with fake information
-		p = plog.pop(0)
+		plog_pop()
 		
 		framecount[0] += 1
-		printinfo()
+		printinfo(wait == 0)
 	
 	# ser.write("~V")
 	#time.sleep(0.001)
@@ -248,18 +334,37 @@ def cleanup():
 	sys.exit(0)
 
 
-def printinfo():
+def printinfo(force = 0):
 	global prebuffer
 	global start
 	global framecount
 	global totalframes
 	global tskip
+	global next_draw
+	global lag_seen
+
+	# the counters and the gamepad display keep up with every frame,
+	ct = time.time()
+	resetting = (framecount == [tskip + prebuffer + 1, 0])
+	if (resetting):
+		start = ct
+
+	if (lagnow):
+		lag_seen = 1
+
+	if (fm[0] == '8'):
+		update_ubw()
 
-	if (framecount == [tskip + prebuffer + 1, 0]):
+	# but the terminal is only redrawn every status_interval seconds.
+	if (not status_interval):
+		return
+	if (ct < next_draw and not resetting and not force):
+		return
+	next_draw = ct + status_interval
+
+	if (resetting):
 		sys.stdout.write("Resetting...")
-		start = time.time()
 	else:
-		ct = time.time()
 		frameadj = framecount[0] - prebuffer
 		if (ftype == '.fm2'):
 			out = "%6u/%6u (%u lag + %u std), %5.2fms, %01u:%02u:%05.2fs " % (
@@ -277,127 +382,91 @@ def printinfo():
 		if (fm[0] == '8'):
 			sys.stdout.write("  " + display_nes())
 
-		if (lagnow):
+		# a lag frame since the last redraw
+		if (lag_seen):
 			sys.stdout.write(" **LAG**")
-		
+			lag_seen = 0
+
 	sys.stdout.write("\033[K\r")
 	sys.stdout.flush()
 
 
 
-# seek to beginning of file, read out amount of bytes to skip
-def fh_setup(skip):
-	global fh
-	global fbuf
+# controller packets: "~", the port id, then two big-endian 32-bit words.
+# one struct per packet stride packs a whole frame in a single call.
+frame_ports = {}
+frame_structs = {}
+for cidx in (2, 4):
+	frame_ports[cidx] = [(x, "~" + chr((x & 2) + (x >> 2) + ord('1'))) for x in range(0, 8, cidx)]
+	frame_structs[cidx] = struct.Struct('>' + '2sII' * len(frame_ports[cidx]))
 
-	fh.seek(0)
 
-	if (ftype == '.fm2'):
-		a = 0
-		while (a < firstline + skip):
-			fbuf = fh.readline()
-			a += 1
-	if (ftype[0:2] == '.r'):
-		# .rXX does not support skipping
-		pass
+# builds every controller packet for one frame as one string
+def frame_packet(b, cidx):
+	args = []
+	for x, port in frame_ports[cidx]:
+		args += (port, b[x], b[x + 1])
 
+	return frame_structs[cidx].pack(*args)
 
-# gets X bits for p1 then X bits for p2 sequentially
-def raw_getbits(bytes):
-	b = {}
 
-	if (ftype == '.r16m'):
-		for x in range(0, 8):
-			b[x] = fh.read(bytes)
-	elif (ftype == '.r08'):
-		for x in range(0, 8):
-			b[x] = chr(0)
-		b[0] = fh.read(bytes)	# p1d0
-		b[4] = fh.read(bytes)	# p2d0
+# the command that sets the device's latch mode
+def latch_command(latches):
+	if (latches.isdigit()):
+		return "~l" + str(int(latches, 10))
+	else:
+		return "~l" + latches[0]
 
-	if (len(b[0]) == 0):
-		# end of file...
-		cleanup()
-		return false
-
-	if (bytes == 1):
-		for x in range(0, 8):
-			b[x] = ord(b[x][0]) << 24;
-	if (bytes == 2):
-		for x in range(0, 8):
-			b[x] = ord(b[x][0]) << 24 | ord(b[x][1]) << 16;
-	if (bytes == 4):
-		pass
-
-	return b
-
-
-# gets the data from the fm2 dataline and returns as 2player bitfield
-def fm2_getbits(fm2_str):
-    p1 = 0
-    p2 = 0
-    
-    if (len(fm2_str) == 0):
-    	cleanup()
-    	return 0, 0
-
-    data = fm2_str.split('|')
-    
-    for x in range(0, 8):
-        p1 = p1 | (0 if (data[2][x] == '.') else (1 << x))
-        if (len(data[3])):
-			p2 = p2 | (0 if (data[3][x] == '.') else (1 << x))
-    
-    return (p1 << 24), (p2 << 24)
 
+# serial writes are collected here and sent with one ser.write
+pending = []
 
-# reads the next input and returns appropriately formatted data
-def send_next_frame(is_reset):
-	global p
-	global plog
-	global ftype
+def queue_write(data):
+	pending.append(data)
 
-	b = {}
-	cidx = 2
+def flush_writes():
+	if (pending):
+		ser.write(''.join(pending))
+		del pending[:]
 
-	if (ftype == '.fm2'):
-		fbuf = fh.readline()
-		b[0], b[4] = fm2_getbits(fbuf)
-	if (ftype[0:2] == '.r'):
-		b = raw_getbits(int(ftype[2:4], 10) / 8)
+
+# reads the next input and returns appropriately formatted data
+def send_next_frame(is_reset):
+	b = source.nextFrame()
+	if (b is None):
+		# end of file...
+		cleanup()
 
 	if b:
-		if (ftype == '.r08'):
-			cidx = 4    # don't need to send multitap for nes, less comms = less problems 
+		cidx = source.packetStride
 
-		for x in range(0, 8, cidx):
-			ser.write("~" + chr((x & 2) + (x >> 2) + ord('1'))
-				+ chr(b[x    ] >> 24) + chr((b[x    ] >> 16) & 0xff) + chr((b[x    ] >> 8) & 0xff) + chr(b[x    ] & 0xff)
-				+ chr(b[x + 1] >> 24) + chr((b[x + 1] >> 16) & 0xff) + chr((b[x + 1] >> 8) & 0xff) + chr(b[x + 1] & 0xff))
-			# time.sleep(0.0005) # scope debug
+		# during a reset the whole prebuffer goes out in one write
+		queue_write(frame_packet(b, cidx))
+		if (not is_reset):
+			flush_writes()
 
 		# add this command to the controller log
-		plog.append(b)
+		plog_push(b)
 		
 		# and get the first entry
 		if (not is_reset):
-			p = plog.pop(0)
+			plog_pop()
 
 	return
 
 
-# prints out nes input shit
-def display_nes():
-	global p
-
-	p1 = p[0] >> 24
-	p2 = p[4] >> 24
-
-	# ubw
+# shows the displayed frame's p1 input on the ubw
+def update_ubw():
 	if (ubw_p1):
-		disp_p1.write('O,0,' + str(~p1 & 0xff) + ',0' + chr(0x0d) + chr(0x0a))
+		disp_p1.write('O,0,' + str(~(plog[p] >> 24) & 0xff) + ',0' + chr(0x0d) + chr(0x0a))
 		disp_p1.read(100)
 
+
+# prints out nes input shit
+def display_nes():
+	p1 = plog[p] >> 24
+	p2 = plog[p + 4] >> 24
+
 	ret = ["", ""]
 	controls = "RLDUteBA"
 	map = [range(3, -1, -1), range(5, 3, -1), range(6, 8)]
@@ -421,43 +490,45 @@ def display_nes():
 t = time.time()
 start = time.time()
 
+next_draw = 0
+lag_seen = 0
+
 reset = 0
 
-fh_setup(skip) # prevents instant 'Done.' when starting with console already on
+source.rewind() # prevents instant 'Done.' when starting with console already on
 
-p[0] = 0 # fixes crash on non-windowed nes playback
-p[4] = 0
 
 print("")
 
 while (1):
-	while (ser.inWaiting() == 0):
-		pass
-
+	# blocks until the device sends a byte, so we wake right away for it
 	c = ser.read()
+	if (not c):
+		continue
+
 	lagnow = 0
 
 	# print("\n" + c)
 	
 	if (c == 'F'):
 		framecount[0] += 1
+
+		# the first chat frame is next to reach the console; switch it to
+		# the chat latch mode in the same write as this frame
+		if (switch_at and frames_shown == switch_at):
+			queue_write(latch_command(switch_latches))
+
 		send_next_frame(0)
-        if (framecount[0] == 8700):
-                ser.write("~l1")
-	        reset = 0
-        #if (framecount[0] == 16368):
-        #        ser.write("~V")
-	#        # reset = 0
+
+		# while chat is playing, a console reset starts everything over
+		if (chat_only or (switch_at and frames_shown > switch_at)):
+			reset = 0
 
 	elif (c == 'L'):
 		framecount[1] += 1
 		lagnow = 1
 		
-		if (ftype == '.fm2'):
-			fbuf = fh.readline()
-		if (ftype[0:2] == '.r'):
-			# nothing to set up
-			pass
+		source.lagFrame()
 
 	elif (c == 'B'):
 		reset = 0
@@ -468,52 +539,52 @@ while (1):
 			framecount = [tskip + prebuffer + 1, 0] 
 
 			# set bitlength to the appropriate size depending on file type,
-			ser.write("~M1" + fm[0])
-			ser.write("~M2" + fm[1])
+			queue_write("~M1" + fm[0])
+			queue_write("~M2" + fm[1])
 
 			# set latches,
-			if (latches.isdigit()):
-				ser.write("~l" + str(int(latches, 10)))
-			else:
-				ser.write("~l" + latches[0])
+			queue_write(latch_command(latches))
 
 			# set sequential lag frame count timeout,
 			if (timeout):
-				ser.write("~t" + chr((timeout >> 8) & 0xff) + chr(timeout & 0xff))
+				queue_write("~t" + chr((timeout >> 8) & 0xff) + chr(timeout & 0xff))
 
 			# start data over,
-			fh_setup(skip)
+			source.rewind()
+			plog_clear()
 
 			# tell the device to reset buffers,
-			ser.write("~r")
+			queue_write("~r")
 
 			# enable / disable lagframe buffer incrementing,
 			if (ftype == '.fm2'):
-				ser.write("~g1")
+				queue_write("~g1")
 			else:
-				ser.write("~g0")
+				queue_write("~g0")
 
 			# force 60fps, disable frame period learning,
-			ser.write("~c6")
+			queue_write("~c6")
 
 			# skip the first ghost latch,
 			if (ftype == '.r08'):
-				ser.write("~s" + chr(skip + ord('0')))
+				queue_write("~s" + chr(skip + ord('0')))
 				# if we are skipping this latch, feed initial empty player data.
 				if (skip):
-					p[0] = 0
-					p[4] = 0
+					p = 0
 
 			# hack in the game fix ID,
 			if (game_fix):
-				ser.write("~h" + chr(game_fix))
+				queue_write("~h" + chr(game_fix))
 			else:
-				ser.write("~h" + chr(0xff))
+				queue_write("~h" + chr(0xff))
 
 			# and feed in first prebuffer bytes.
-			for x in range(0, prebuffer):		
+			for x in range(0, prebuffer):
 				send_next_frame(1)
 
+			# and send all of the above in one go.
+			flush_writes()
+
 			# also mark as reset so we don't do this again.
 			reset = 1
 		
@@ -0,0 +1,64 @@
+#Screenplay handling for the IRC bots
+#Reading the script and reporting how well its timing was kept are the same
+#for theaxebot.py and themicrobot.py, so both use the code here.
+
+import re
+import sys
+
+
+#Screenplay lines later than this many seconds are counted as late
+LateLineThreshold = 0.1
+
+
+def parseScreenPlay(lines):
+    """
+    The screenplay lines as a list of (delay, speaker, text)
+
+    >>> parseScreenPlay(['# a comment', '1.5 TASBot: Hello there', '', '0 tasbot hi'])
+    [(1.5, 'tasbot', 'Hello there'), (0.0, 'tasbot', 'hi')]
+    """
+    script = []
+    for line in lines:
+        #Commented lines with #
+        if re.match("\s*#", line):
+            continue
+        m = re.match(r'(?P<delay>\S+)\s+(?P<speaker>\S+?):?\s+(?P<text>.+)', line)
+        if not m:
+            continue
+        delay = float(m.group('delay'))
+        speaker = m.group('speaker').lower()
+        text = m.group('text')
+        script.append((delay, speaker, text))
+    return script
+
+
+def readScreenPlay(filename):
+    """The screenplay in filename as a list of (delay, speaker, text)"""
+    with open(filename) as rawScript:
+        return parseScreenPlay(rawScript)
+
+
+def latenessReport(lateness):
+    """
+    Sum up how many seconds late each screenplay line was
+
+    >>> latenessReport([])
+    'no lines'
+    >>> latenessReport([0.0, 0.05, 0.25])
+    '3 lines, 0.100s late on average, 0.250s at worst, 1 over 0.1s late'
+    """
+    if not lateness:
+        return 'no lines'
+    late = sum(1 for seconds in lateness if seconds > LateLineThreshold)
+    return '{} lines, {:.3f}s late on average, {:.3f}s at worst, {} over {}s late'.format(
+        len(lateness), sum(lateness) / len(lateness), max(lateness), late, LateLineThreshold)
+
+
+if __name__ == '__main__':
+    if '--test' in sys.argv:
+        import doctest
+        res = doctest.testmod()
+        sys.exit(1 if res.failed else 0)
+
+    sys.stderr.write('Usage: %s --test\n' % sys.argv[0])
+    sys.exit(2)
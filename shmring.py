@@ -0,0 +1,195 @@
+#Shared memory ring buffer between the IRC bot and the replay
+#One writer and one reader pass records through a file in /dev/shm that both
+#memory map, so a line costs no syscalls once the ring is open. Each record is
+#a kind, a sequence number and a payload of bytes.
+#
+#The writer only ever moves head and the reader only ever moves tail, so no
+#locking is needed. Python has no memory fence, and on weakly ordered CPUs
+#like the Pi's ARM cores the reader can see a new head before the record it
+#covers. So every record carries its sequence number and a crc32, and the
+#reader leaves a record alone until both check out. The counters are native
+#32-bit ints, which struct reads and writes in one go.
+
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+
+RING_DIR = '/dev/shm'
+RING_CAPACITY = 1 << 20  # Bytes of records, a power of two.
+RING_VERSION = 2
+
+RingHeader = struct.Struct('<4sHxxI')   # magic, version, capacity
+Counter = struct.Struct('I')            # native, so one aligned store
+CounterMask = 0xFFFFFFFF
+#head and nextSeq belong to the writer, tail to the reader. They get their
+#own cache lines so the two sides don't fight over one.
+HeadOffset = 64
+NextSeqOffset = 68
+TailOffset = 128
+DataOffset = 192
+
+RecordFields = struct.Struct('<IIH')
+RecordHeader = struct.Struct('<IIHxxI')  # payload length, sequence, kind, crc32
+RecordAlign = 16
+#Fills the space at the end of the ring when a record doesn't fit there
+PadKind = 0xFFFF
+
+
+def ringPath(name):
+    return os.path.join(RING_DIR, name)
+
+
+def recordSize(length):
+    """Bytes a record with this much payload takes in the ring"""
+    return (RecordHeader.size + length + RecordAlign - 1) & ~(RecordAlign - 1)
+
+
+def recordCrc(length, seq, kind, payload):
+    return zlib.crc32(buffer(payload), zlib.crc32(RecordFields.pack(length, seq, kind))) & CounterMask
+
+
+class ShmRing(object):
+    """
+    One end of a ring. The reader creates it with create=True, which starts
+    it empty. The writer opens the existing ring, and IOError or OSError
+    mean the reader isn't up yet.
+
+    >>> name = 'shmring-doctest-%d' % os.getpid()
+    >>> reader = ShmRing(name, capacity=64, create=True)
+    >>> writer = ShmRing(name)
+    >>> writer.put(1, 'hello'), writer.put(2, 'there'), writer.put(1, 'full')
+    (True, True, False)
+    >>> reader.get()
+    (0, 1, bytearray(b'hello'))
+    >>> writer.put(1, 'wraps')
+    True
+    >>> reader.get(), reader.get(), reader.get()
+    ((1, 2, bytearray(b'there')), (2, 1, bytearray(b'wraps')), None)
+
+    A record the reader can't see all of yet stays in the ring.
+
+    >>> writer.put(3, 'torn')
+    True
+    >>> writer.map[DataOffset + 32 + RecordHeader.size] = 'T'
+    >>> reader.get()
+    >>> writer.map[DataOffset + 32 + RecordHeader.size] = 't'
+    >>> reader.get()
+    (3, 3, bytearray(b'torn'))
+    >>> reader.unlink()
+    """
+    def __init__(self, name, capacity=RING_CAPACITY, create=False):
+        self.path = ringPath(name)
+        if create:
+            if capacity & (capacity - 1):
+                #The counters wrap at 2**32, so positions only line up if
+                #the capacity divides that
+                raise ValueError('Ring capacity must be a power of two')
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                os.ftruncate(fd, DataOffset + capacity)
+                self.map = mmap.mmap(fd, DataOffset + capacity)
+            finally:
+                os.close(fd)
+            RingHeader.pack_into(self.map, 0, 'PPTR', RING_VERSION, capacity)
+            for offset in (HeadOffset, NextSeqOffset, TailOffset):
+                Counter.pack_into(self.map, offset, 0)
+        else:
+            fd = os.open(self.path, os.O_RDWR)
+            try:
+                self.map = mmap.mmap(fd, 0)
+            finally:
+                os.close(fd)
+            magic, version, capacity = RingHeader.unpack_from(self.map, 0)
+            if magic != 'PPTR' or version != RING_VERSION:
+                self.map.close()
+                raise IOError('%s is not a version %d ring' % (self.path, RING_VERSION))
+        self.capacity = capacity
+        #Where the reader is up to. Only the reader uses these.
+        self.tail = Counter.unpack_from(self.map, TailOffset)[0]
+        self.nextSeq = Counter.unpack_from(self.map, NextSeqOffset)[0]
+
+    def put(self, kind, payload):
+        """Add a record. False if the ring is too full for it right now."""
+        size = recordSize(len(payload))
+        if size > self.capacity:
+            raise ValueError('Record of %d bytes is too big for the ring' % len(payload))
+        head = Counter.unpack_from(self.map, HeadOffset)[0]
+        tail = Counter.unpack_from(self.map, TailOffset)[0]
+        pos = head % self.capacity
+        padding = self.capacity - pos if pos + size > self.capacity else 0
+        if ((head - tail) & CounterMask) + padding + size > self.capacity:
+            return False
+
+        seq = Counter.unpack_from(self.map, NextSeqOffset)[0]
+        if padding:
+            #A pad record takes a sequence number too, so the reader can
+            #tell it from an old one
+            length = padding - RecordHeader.size
+            RecordHeader.pack_into(self.map, DataOffset + pos, length, seq, PadKind,
+                                   recordCrc(length, seq, PadKind, ''))
+            seq = (seq + 1) & CounterMask
+            pos = 0
+        start = DataOffset + pos
+        payload = str(payload)
+        RecordHeader.pack_into(self.map, start, len(payload), seq, kind,
+                               recordCrc(len(payload), seq, kind, payload))
+        self.map[start + RecordHeader.size:start + RecordHeader.size + len(payload)] = payload
+        Counter.pack_into(self.map, NextSeqOffset, (seq + 1) & CounterMask)
+        #Publish the record last
+        Counter.pack_into(self.map, HeadOffset, (head + padding + size) & CounterMask)
+        return True
+
+    def get(self):
+        """The next record as (sequence, kind, payload), or None if there
+           isn't one yet. The payload is copied out as a bytearray since its
+           space in the ring is reused once read.
+        """
+        head = Counter.unpack_from(self.map, HeadOffset)[0]
+        while self.tail != head:
+            pos = self.tail % self.capacity
+            length, seq, kind, crc = RecordHeader.unpack_from(self.map, DataOffset + pos)
+            start = DataOffset + pos + RecordHeader.size
+            if seq != self.nextSeq or length > self.capacity - pos - RecordHeader.size:
+                #Not all there yet
+                return None
+            if kind == PadKind:
+                payload = ''
+            else:
+                payload = bytearray(buffer(self.map, start, length))
+            if crc != recordCrc(length, seq, kind, payload):
+                return None
+
+            self.nextSeq = (seq + 1) & CounterMask
+            if kind == PadKind:
+                self.tail = (self.tail + self.capacity - pos) & CounterMask
+            else:
+                self.tail = (self.tail + recordSize(length)) & CounterMask
+            Counter.pack_into(self.map, TailOffset, self.tail)
+            if kind != PadKind:
+                return seq, kind, payload
+        return None
+
+    def empty(self):
+        """True if there is nothing to read. Cheap enough to call every word."""
+        return self.tail == Counter.unpack_from(self.map, HeadOffset)[0]
+
+    def close(self):
+        self.map.close()
+
+    def unlink(self):
+        """Close and remove the ring"""
+        self.close()
+        os.unlink(self.path)
+
+
+if __name__ == '__main__':
+    if '--test' in sys.argv:
+        import doctest
+        res = doctest.testmod()
+        sys.exit(1 if res.failed else 0)
+
+    sys.stderr.write('Usage: %s --test\n' % sys.argv[0])
+    sys.exit(2)
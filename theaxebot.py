@@ -9,10 +9,17 @@ import re
 import yaml
 import os
 import time
-from threading import Thread
+import errno
+import heapq
 import traceback
-from Queue import Queue
-from subprocess import call
+from collections import deque
+from itertools import count
+from subprocess import Popen
+
+from chatfilter import ChatFilter, RateLimiter, SpamCollapser, readBadWords
+from screenplay import latenessReport, readScreenPlay
+from pptcontrol import encodePipeRecord, lineRecord
+from shmring import ShmRing
 
 #Setting the global logger to debug gets all sorts of irc debugging
 logging.getLogger().setLevel(logging.WARNING)
@@ -35,109 +42,240 @@ IrcPassword = settings.get('IrcPassword', None)
 IrcChannel = settings.get('IrcChannel', '#lsnes')
 
 ReplayPipeName = settings.get('ReplayPipeName', 'replay_pipe')
+ReplayRingName = settings.get('ReplayRingName', None)
+#Send lines to the replay already as codes, see pptcontrol.encodePipeRecord
+ReplayPipeBinary = settings.get('ReplayPipeBinary', False)
+#Seconds a line may wait for more to go in the same write to the replay pipe
+ReplayBatchLatency = settings.get('ReplayBatchLatency', 0.01)
 TasbotPipeName = settings.get('TasbotPipeName', 'tasbot_pipe')
 ScreenPlayFileName = settings.get('ScreenPlayFileName', 'screenplay.txt')
 
 TasbotPipeEnable = settings.get('TasbotPipeEnable', False)
-TasbotEspeakEnable = settings.get('ScreenPlayFileName', True)
+TasbotEspeakEnable = settings.get('TasbotEspeakEnable', True)
 
+#Seconds that repeats of a chat line are collapsed for
+SpamWindow = settings.get('SpamWindow', 10)
 
-def writeToPipe(writePipe, msg):
-    """Utility function to write a message to a pipe.
-       First add a newline if it doesn't have one.
-       Then write the message and flush the pipe.
-    """
-    if not msg.endswith('\n'):
-        msg += '\n'
-    writePipe.write(msg)
-    writePipe.flush()
-
-
-class ReplayTextThread(Thread):
-    """This thread grabs strings off the queue and writes them to the
-       pipe that the replay script should be reading from.
-       This ensures thread safety between the multiple threads that need
-       to write to that pipe.
-       It will never stop so do not wait for it!
+#Lines a second each nick may post after a burst of ChatRateBurst lines, and
+#how many nicks to keep track of
+ChatRateLimit = settings.get('ChatRateLimit', 0.2)
+ChatRateBurst = settings.get('ChatRateBurst', 3)
+ChatRateUsers = settings.get('ChatRateUsers', 10000)
+
+
+#Seconds between tries to reach a pipe with no reader or a full buffer
+PipeRetryDelay = 0.05
+#Seconds between checks whether espeak is done
+SpeechPollInterval = 0.05
+#Seconds between sweeps for spam windows that have closed
+SpamFlushInterval = 1.0
+
+
+class Timers(object):
+    """Functions to call at a given time, soonest first.
+       Everything the bot does after connecting runs from these or from the
+       irc reactor, all on the one thread.
     """
-    def __init__(self, replayQueue):
-        super(ReplayTextThread, self).__init__()
+    def __init__(self):
+        self.heap = []
+        #Ties are run in the order they were added
+        self.order = count()
 
-        self.replayQueue = replayQueue
+    def callLater(self, delay, func, *args):
+        self.callAt(time.time() + delay, func, *args)
 
-    def run(self):
-        if not os.path.exists(ReplayPipeName):
-            os.mkfifo(ReplayPipeName)
-        writePipe = open(ReplayPipeName, 'w')
-        while True:
-            msg = self.replayQueue.get()
-            writeToPipe(writePipe, msg)
+    def callAt(self, when, func, *args):
+        heapq.heappush(self.heap, (when, next(self.order), func, args))
 
+    def timeout(self, now):
+        """Seconds until the next timer is due, or None if there are none"""
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - now)
 
-class ScreenPlayThread(Thread):
-    def __init__(self, ircBot):
-        super(ScreenPlayThread, self).__init__()
+    def runDue(self, now):
+        """Run the timers that are due. One that fails is reported and the
+           rest carry on, so a screenplay error doesn't stop chat.
+        """
+        while self.heap and self.heap[0][0] <= now:
+            when, _, func, args = heapq.heappop(self.heap)
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+
+
+class PipeWriter(object):
+    r"""Writes lines to a fifo without ever blocking.
+       Lines are held until a reader opens the fifo, and whatever doesn't fit
+       in the fifo is tried again later. If the reader goes away the lines
+       wait for the next one. With binary set lines go as binary records.
+       Lines written within batchLatency seconds of the first go out in one
+       write, so the reader wakes up once for a burst of chat.
+
+       A reader that goes away in the middle of a line throws that part
+       away, so the next reader gets the whole line again, never its tail.
+
+    >>> name = 'pipewriter-doctest-%d' % os.getpid()
+    >>> pipe = PipeWriter(name, Timers())
+    >>> reader = os.open(name, os.O_RDONLY | os.O_NONBLOCK)
+    >>> record = 'amy:' + 'x' * 995 + '\n'
+    >>> for i in xrange(200):
+    ...     pipe.write(record)
+    >>> pipe.flush()
+    >>> 0 < pipe.sentBytes < len(record)
+    True
+    >>> os.close(reader)
+    >>> pipe.flush()
+    >>> pipe.fd, pipe.sentBytes
+    (None, 0)
+    >>> reader = os.open(name, os.O_RDONLY | os.O_NONBLOCK)
+    >>> pipe.flush()
+    >>> os.read(reader, len(record)) == record
+    True
+    >>> os.close(reader)
+    >>> os.close(pipe.fd)
+    >>> os.unlink(name)
+    """
+    def __init__(self, name, timers, binary=False, batchLatency=0):
+        self.name = name
+        self.timers = timers
+        self.binary = binary
+        self.batchLatency = batchLatency
+        self.fd = None
+        #Whole lines, and how much of the first one has been written
+        self.pending = []
+        self.sentBytes = 0
+        self.flushScheduled = False
+        if not os.path.exists(name):
+            os.mkfifo(name)
+
+    def write(self, msg):
+        """Queue a message, adding a newline if it doesn't have one"""
+        if self.binary:
+            msg = encodePipeRecord(msg.rstrip('\n'), time.time())
+        elif not msg.endswith('\n'):
+            msg += '\n'
+        self.pending.append(msg)
+        self.scheduleFlush(self.batchLatency)
+
+    def scheduleFlush(self, delay):
+        if not self.flushScheduled:
+            self.flushScheduled = True
+            self.timers.callLater(delay, self.flush)
+
+    def flush(self):
+        self.flushScheduled = False
+        if not self.pending:
+            return
+        if self.fd is None:
+            try:
+                self.fd = os.open(self.name, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                #ENXIO is no reader yet
+                if e.errno != errno.ENXIO:
+                    raise
+                self.scheduleFlush(PipeRetryDelay)
+                return
 
-        self.ircBot = ircBot
-        self.script = []
-        self.readScreenPlay(ScreenPlayFileName)
-
-    def readScreenPlay(self, filename):
-        if TasbotPipeEnable:
-            if not os.path.exists(TasbotPipeName):
-                os.mkfifo(TasbotPipeName)
-
-        with open(filename) as rawScript:
-            for line in rawScript:
-                #Commented lines with #
-                if re.match("\s*#", line):
-                    continue
-                m = re.match(r'(?P<delay>\S+)\s+(?P<speaker>\S+?):?\s+(?P<text>.+)', line)
-                if not m:
-                    continue
-                delay = float(m.group('delay'))
-                speaker = m.group('speaker').lower()
-                text = m.group('text')
-                self.script.append((delay, speaker, text))
-        print 'Loaded script with {} lines'.format(len(self.script))
-
-    def run(self):
+        data = ''.join(self.pending)[self.sentBytes:]
         try:
-            if TasbotPipeEnable:
-                tasBotPipe = open(TasbotPipeName, 'w')
-            for delay, speaker, text in self.script:
-                time.sleep(delay)
-                debug("%s says %s" % (speaker, text))
-                if speaker == 'red':
-                    self.ircBot.replayQueue.put("<red>:" + text)
-                    self.ircBot.sendMessage(text)
-                if speaker == 'tasbot':
-                    if TasbotPipeEnable:
-                        writeToPipe(tasBotPipe, text)
-                    if TasbotEspeakEnable:
-                        call(['espeak', '-p42', '-s140', '-m', text])
-                        # call("espeak -p42 -s140 -m --stdout " + text)
-                        #call(["espeak -p42 -s140 -m --stdout " + text + " | aplay -D 'hw'"])
-                                                                                                
-                if speaker == 'tasbott':
-                    msg = u'TASBot says: {}'.format(text)
-                    self.ircBot.sendMessage(msg)
-        except:
-            traceback.print_exc()
-            sys.exit(1)
+            written = os.write(self.fd, data)
+        except OSError as e:
+            if e.errno == errno.EPIPE:
+                os.close(self.fd)
+                self.fd = None
+                #The reader dropped the part of the first line it got, so
+                #the next reader gets it from the start
+                self.sentBytes = 0
+            elif e.errno != errno.EAGAIN:
+                raise
+            written = 0
+
+        written += self.sentBytes
+        sent = 0
+        for msg in self.pending:
+            if written < len(msg):
+                break
+            written -= len(msg)
+            sent += 1
+        del self.pending[:sent]
+        self.sentBytes = written
+        if self.pending:
+            self.scheduleFlush(PipeRetryDelay)
+
+
+class RingWriter(PipeWriter):
+    """Writes lines into the replay's shared memory ring instead of a pipe,
+       as records that are already codes, see pptcontrol.lineRecord.
+       Lines wait until the replay has made the ring and while it is full.
+    """
+    def __init__(self, name, timers, batchLatency=0):
+        self.name = name
+        self.timers = timers
+        self.batchLatency = batchLatency
+        self.ring = None
+        self.pending = []
+        self.flushScheduled = False
+
+    def write(self, msg):
+        self.pending.append(lineRecord(msg.rstrip('\n')))
+        self.scheduleFlush(self.batchLatency)
+
+    def flush(self):
+        self.flushScheduled = False
+        if self.ring is None:
+            try:
+                self.ring = ShmRing(self.name)
+            except (IOError, OSError):
+                #The replay isn't up yet
+                self.scheduleFlush(PipeRetryDelay)
+                return
+
+        sent = 0
+        for kind, payload in self.pending:
+            if not self.ring.put(kind, payload):
+                break
+            sent += 1
+        del self.pending[:sent]
+        if self.pending:
+            self.scheduleFlush(PipeRetryDelay)
 
 
 class PptIrcBot(irc.client.SimpleIRCClient):
     def __init__(self):
         irc.client.SimpleIRCClient.__init__(self)
-        self.badWords = self.getBadWords('bad-words.txt')
+        #All the moderation rules, compiled into a single regex
+        self.chatFilter = ChatFilter(readBadWords('bad-words.txt'))
+        #Collapses spam into one line with a count
+        self.spamCollapser = SpamCollapser(SpamWindow)
+        #Shares the chat out fairly between nicks
+        self.rateLimiter = RateLimiter(ChatRateLimit, ChatRateBurst, ChatRateUsers)
         #Precompiled tokenizing regex
         self.splitter = re.compile(r'[^\w]+')
-        self.urlregex = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
-        self.otherbadregex = re.compile(r'\.((com)|(org)|(net))')
-        self.replayQueue = Queue()
-        self.nonPrintingChars = set([chr(i) for i in xrange(32)])
-        self.nonPrintingChars.add(127)
+        self.timers = Timers()
+        if ReplayRingName is None:
+            self.replayPipe = PipeWriter(ReplayPipeName, self.timers, ReplayPipeBinary,
+                                         ReplayBatchLatency)
+        else:
+            self.replayPipe = RingWriter(ReplayRingName, self.timers, ReplayBatchLatency)
+        self.tasbotPipe = None
+        self.script = []
+        self.scriptPos = 0
+        self.scriptDeadline = 0
+        self.lateness = []
+        self.speechEnabled = TasbotEspeakEnable
+        self.espeak = None
+        self.speech = deque()
+
+    def start(self):
+        """Run the bot. The irc reactor waits for chat until the next timer
+           is due, so chat, the screenplay and the pipes share one thread.
+        """
+        while True:
+            timeout = self.timers.timeout(time.time())
+            self.reactor.process_once(0.2 if timeout is None else timeout)
+            self.timers.runDue(time.time())
 
     def sendMessage(self, msg):
         # We don't want this showing up in chat:
@@ -157,19 +295,72 @@ class PptIrcBot(irc.client.SimpleIRCClient):
         """
         if (event.source.find(IrcNick) != -1):
             print "I joined!"
-            self.screenPlayThread = ScreenPlayThread(self)
-            self.replayThread = ReplayTextThread(self.replayQueue)
-            print 'starting replay thread'
-            self.replayThread.start()
-            print 'starting screenplay thread'
-            self.screenPlayThread.start()
-
-        # self.screenPlayThread = ScreenPlayThread(self)
-        # self.replayThread = ReplayTextThread(self.replayQueue)
-        # print 'starting replay thread'
-        # self.replayThread.start()
-        # print 'starting screenplay thread'
-        # self.screenPlayThread.start()
+            if TasbotPipeEnable:
+                self.tasbotPipe = PipeWriter(TasbotPipeName, self.timers)
+            self.script = readScreenPlay(ScreenPlayFileName)
+            print 'Loaded script with {} lines'.format(len(self.script))
+            self.scriptPos = 0
+            self.scriptDeadline = time.time()
+            self.lateness = []
+            print 'starting screenplay'
+            self.scheduleNextLine()
+            self.timers.callLater(SpamFlushInterval, self.flushSpam)
+
+    def scheduleNextLine(self):
+        """Each line is due its delay after the last one was due, not after
+           it was said, so lateness doesn't add up over the script.
+        """
+        if self.scriptPos < len(self.script):
+            self.scriptDeadline += self.script[self.scriptPos][0]
+            self.timers.callAt(self.scriptDeadline, self.playLine)
+        else:
+            print 'Screenplay done: ' + latenessReport(self.lateness)
+
+    def playLine(self):
+        delay, speaker, text = self.script[self.scriptPos]
+        self.scriptPos += 1
+        lateness = time.time() - self.scriptDeadline
+        self.lateness.append(lateness)
+        debug("%s says %s (%.3fs late)" % (speaker, text, lateness))
+        if speaker == 'red':
+            self.replayPipe.write("<red>:" + text)
+            self.sendMessage(text)
+        if speaker == 'tasbot':
+            if self.tasbotPipe is not None:
+                self.tasbotPipe.write(text)
+            if self.speechEnabled:
+                self.speech.append(text)
+                if self.espeak is None:
+                    self.nextSpeech()
+        if speaker == 'tasbott':
+            msg = u'TASBot says: {}'.format(text)
+            self.sendMessage(msg)
+        self.scheduleNextLine()
+
+    def nextSpeech(self):
+        """Start espeak on the next of tasbot's lines once it is done with
+           the last, so lines that come quickly don't talk over each other.
+        """
+        if self.espeak is not None and self.espeak.poll() is None:
+            self.timers.callLater(SpeechPollInterval, self.nextSpeech)
+            return
+        self.espeak = None
+        if self.speech:
+            try:
+                self.espeak = Popen(['espeak', '-p42', '-s140', '-m', self.speech.popleft()])
+            except OSError as e:
+                #No espeak, so no more speech but the script goes on
+                print 'Turning off speech, espeak failed: %s' % e
+                self.speechEnabled = False
+                self.speech.clear()
+                return
+            self.timers.callLater(SpeechPollInterval, self.nextSpeech)
+
+    def flushSpam(self):
+        """Send the counts for spam windows that closed with no chat since"""
+        for line in self.spamCollapser.flush(time.time()):
+            self.replayPipe.write(line)
+        self.timers.callLater(SpamFlushInterval, self.flushSpam)
 
     def on_disconnect(self, connection, event):
         sys.exit(0)
@@ -197,26 +388,13 @@ class PptIrcBot(irc.client.SimpleIRCClient):
             #I am not sure what else can happen but just to be safe, reject on other errors
             return
 
-        if self.urlregex.search(text):
-            self.naughtyMessage(sender, "url")
-            return
-
-        if self.otherbadregex.search(text):
-            self.naughtyMessage(sender, "url-like")
-            return
-
-        #We probably also want to filter some typically non-printing ascii chars:
-        #[18:12] <@Ilari> Also, one might want to drop character codes 0-31 and 127. And then map the icons to some of those.
-        if any(c in self.nonPrintingChars for c in text):
-            self.naughtyMessage(sender, "non-printing chars")
+        #One scan for urls, non-printing chars and bad words
+        reason = self.chatFilter.check(text)
+        if reason is not None:
+            self.naughtyMessage(sender, reason)
             return
 
         text_lower = text.lower()
-        for badword_regex in self.badWords:
-            if badword_regex.search(text_lower):
-                self.naughtyMessage(sender, "bad word: " + badword_regex.pattern)
-                return
-
         words = self.splitter.split(text_lower)
         words = map(lambda x: x.lower(), words)
         print words
@@ -224,40 +402,14 @@ class PptIrcBot(irc.client.SimpleIRCClient):
         # if any(word.lower() in self.badWords for word in words):
             # self.naughtyMessage(sender, "bad word:" + word)
             # return
-        self.replayQueue.put(text)
-
-    def getBadWords(self, filename):
-        #Make sure all the entries are lower case
-        #We lower-case the incoming text to make the check case-insensitive
-        badWords = open(filename)
-        badWordList_strings = set([word.strip().lower() for word in badWords.readlines()])
-        badWords.close()
-
-        if '' in badWordList_strings:
-            badWordList_strings.remove('')
-
-        badWordList_regex_strings = []
-
-        for word in badWordList_strings:
-            word = re.sub(r'[sz]', '[s5z2$]', word)
-            word = re.sub(r'a', '[a4]', word)
-            word = re.sub(r'e', '[e3]', word)
-            word = re.sub(r'i', '[i1]', word)
-            word = re.sub(r'l', '[l1]', word)
-            word = re.sub(r'o', '[o0]', word)
-            word = re.sub(r't', '[t7]', word)
-            word = re.sub(r'g', '[g6]', word)
-            word = re.sub(r'b', '[b8]', word)
-            word = re.sub(r'f', '(f|ph)', word)
-            word = re.sub(r'(c|k)', '[ck]', word)
-            badWordList_regex_strings.append(word)
-
-        badWordList = []
-
-        for word in badWordList_regex_strings:
-            badWordList.append(re.compile(word))
+        now = time.time()
+        if not self.rateLimiter.allow(sender, now):
+            self.naughtyMessage(sender, "rate limited")
+            return
 
-        return badWordList
+        #Repeats are held back and sent later as one line with a count
+        for line in self.spamCollapser.add(text, now):
+            self.replayPipe.write(line)
 
 
 def main():
@@ -282,4 +434,9 @@ def main():
     c.start()
 
 if __name__ == "__main__":
+    if '--test' in sys.argv:
+        import doctest
+        res = doctest.testmod()
+        sys.exit(1 if res.failed else 0)
+
     main()
@@ -9,10 +9,13 @@ import re
 import yaml
 import os
 import time
-from threading import Thread
-from Queue import Queue
+from threading import Thread, Lock
+from Queue import Queue, Empty
 from subprocess import call
 
+from chatfilter import ChatFilter, RateLimiter, SpamCollapser, readBadWords
+from screenplay import latenessReport, readScreenPlay
+
 #Setting the global logger to debug gets all sorts of irc debugging
 #logging.getLogger().setLevel(logging.DEBUG)
 
@@ -42,7 +45,21 @@ TasbotPipeName = settings.get('TasbotPipeName', 'tasbot_pipe')
 ScreenPlayFileName = settings.get('ScreenPlayFileName', 'screenplay.txt')
 
 TasbotPipeEnable = settings.get('TasbotPipeEnable', False)
-TasbotEspeakEnable = settings.get('ScreenPlayFileName', True)
+TasbotEspeakEnable = settings.get('TasbotEspeakEnable', True)
+
+#Seconds that repeats of a chat line are collapsed for
+SpamWindow = settings.get('SpamWindow', 10)
+#Seconds between sweeps for spam windows that have closed
+SpamFlushInterval = 1.0
+
+#Lines a second each nick may post after a burst of ChatRateBurst lines, and
+#how many nicks to keep track of
+ChatRateLimit = settings.get('ChatRateLimit', 0.2)
+ChatRateBurst = settings.get('ChatRateBurst', 3)
+ChatRateUsers = settings.get('ChatRateUsers', 10000)
+
+#Seconds a line may wait for more to go in the same write to the replay pipe
+ReplayBatchLatency = settings.get('ReplayBatchLatency', 0.01)
 
 
 def writeToPipe(writePipe, msg):
@@ -56,11 +73,19 @@ def writeToPipe(writePipe, msg):
     writePipe.flush()
 
 
+def writeLinesToPipe(writePipe, msgs):
+    """Like writeToPipe for a batch of messages, with one write and flush"""
+    writePipe.write(''.join(msg if msg.endswith('\n') else msg + '\n' for msg in msgs))
+    writePipe.flush()
+
+
 class ReplayTextThread(Thread):
     """This thread grabs strings off the queue and writes them to the
        pipe that the replay script should be reading from.
        This ensures thread safety between the multiple threads that need
        to write to that pipe.
+       Lines that come in within ReplayBatchLatency of each other are
+       written together, so the replay wakes up once for a burst of chat.
        It will never stop so do not wait for it!
     """
     def __init__(self, replayQueue):
@@ -73,8 +98,34 @@ class ReplayTextThread(Thread):
             os.mkfifo(ReplayPipeName)
         writePipe = open(ReplayPipeName, 'w')
         while True:
-            msg = self.replayQueue.get()
-            writeToPipe(writePipe, msg)
+            msgs = [self.replayQueue.get()]
+            deadline = time.time() + ReplayBatchLatency
+            while True:
+                #Wait for more until the deadline, then take what is left
+                remaining = deadline - time.time()
+                try:
+                    msgs.append(self.replayQueue.get(remaining > 0, max(remaining, 0)))
+                except Empty:
+                    break
+            writeLinesToPipe(writePipe, msgs)
+
+
+class SpamFlushThread(Thread):
+    """Sends the counts for spam windows that close while chat is quiet.
+       It will never stop so do not wait for it!
+    """
+    def __init__(self, ircBot):
+        super(SpamFlushThread, self).__init__()
+
+        self.ircBot = ircBot
+
+    def run(self):
+        while True:
+            time.sleep(SpamFlushInterval)
+            with self.ircBot.spamLock:
+                lines = self.ircBot.spamCollapser.flush(time.time())
+            for line in lines:
+                self.ircBot.replayQueue.put(line)
 
 
 class ScreenPlayThread(Thread):
@@ -82,22 +133,7 @@ class ScreenPlayThread(Thread):
         super(ScreenPlayThread, self).__init__()
 
         self.ircBot = ircBot
-        self.script = []
-        self.readScreenPlay(ScreenPlayFileName)
-
-    def readScreenPlay(self, filename):
-        with open(filename) as rawScript:
-            for line in rawScript:
-                #Commented lines with #
-                if re.match("\s*#", line):
-                    continue
-                m = re.match(r'(?P<delay>\S+)\s+(?P<speaker>\S+?):?\s+(?P<text>.+)', line)
-                if not m:
-                    continue
-                delay = float(m.group('delay'))
-                speaker = m.group('speaker').lower()
-                text = m.group('text')
-                self.script.append((delay, speaker, text))
+        self.script = readScreenPlay(ScreenPlayFileName)
 
     def run(self):
         if TasbotPipeEnable:
@@ -105,8 +141,14 @@ class ScreenPlayThread(Thread):
                 os.mkfifo(TasbotPipeName)
             tasBotPipe = open(TasbotPipeName, 'w')
 
+        #Each line is due its delay after the last one was due, not after
+        #it was said, so time spent speaking doesn't add up over the script
+        deadline = time.time()
+        lateness = []
         for delay, speaker, text in self.script:
-            time.sleep(delay)
+            deadline += delay
+            time.sleep(max(0, deadline - time.time()))
+            lateness.append(time.time() - deadline)
             #debug("%s says %s" % (speaker, text))
             if speaker == 'red':
                 self.ircBot.replayQueue.put("<red>:" + text)
@@ -126,18 +168,22 @@ class ScreenPlayThread(Thread):
                 self.ircBot.replayQueue.put("dwangoAC:" + text)
                 # msg = u'TASBot says: {}'.format(text)
                 #self.ircBot.sendMessage(msg)
+        print 'Screenplay done: ' + latenessReport(lateness)
 
 class PptIrcBot(irc.client.SimpleIRCClient):
     def __init__(self):
         irc.client.SimpleIRCClient.__init__(self)
-        self.badWords = self.getBadWords('bad-words.txt')
+        #All the moderation rules, compiled into a single regex
+        self.chatFilter = ChatFilter(readBadWords('bad-words.txt'))
+        #Collapses spam into one line with a count
+        self.spamCollapser = SpamCollapser(SpamWindow)
+        #The spam flush thread uses it too
+        self.spamLock = Lock()
+        #Shares the chat out fairly between nicks
+        self.rateLimiter = RateLimiter(ChatRateLimit, ChatRateBurst, ChatRateUsers)
         #Precompiled tokenizing regex
         self.splitter = re.compile(r'[^\w]+')
-        self.urlregex = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
-        self.otherbadregex = re.compile(r'\.((com)|(org)|(net))')
         self.replayQueue = Queue()
-        self.nonPrintingChars = set([chr(i) for i in xrange(32)])
-        self.nonPrintingChars.add(127)
 
     def on_welcome(self, connection, event):
         print 'joining', IrcChannel
@@ -155,6 +201,8 @@ class PptIrcBot(irc.client.SimpleIRCClient):
             self.replayThread.start()
             print 'starting screenplay thread'
             self.screenPlayThread.start()
+            self.spamFlushThread = SpamFlushThread(self)
+            self.spamFlushThread.start()
 
         # self.screenPlayThread = ScreenPlayThread(self)
         # self.replayThread = ReplayTextThread(self.replayQueue)
@@ -188,26 +236,13 @@ class PptIrcBot(irc.client.SimpleIRCClient):
             #I am not sure what else can happen but just to be safe, reject on other errors
             return
 
-        if self.urlregex.search(text):
-            self.naughtyMessage(sender, "url")
-            return
-
-        if self.otherbadregex.search(text):
-            self.naughtyMessage(sender, "url-like")
-            return
-
-        #We probably also want to filter some typically non-printing ascii chars:
-        #[18:12] <@Ilari> Also, one might want to drop character codes 0-31 and 127. And then map the icons to some of those.
-        if any(c in self.nonPrintingChars for c in text):
-            self.naughtyMessage(sender, "non-printing chars")
+        #One scan for urls, non-printing chars and bad words
+        reason = self.chatFilter.check(text)
+        if reason is not None:
+            self.naughtyMessage(sender, reason)
             return
 
         text_lower = text.lower()
-        for badword_regex in self.badWords:
-          if badword_regex.search(text_lower):
-            self.naughtyMessage(sender, "bad word: " + badword_regex.pattern)
-            return
-        
         words = self.splitter.split(text_lower)
         words = map(lambda x:x.lower(),words)
         print words
@@ -215,40 +250,16 @@ class PptIrcBot(irc.client.SimpleIRCClient):
         # if any(word.lower() in self.badWords for word in words):
             # self.naughtyMessage(sender, "bad word:" + word)
             # return
-        self.replayQueue.put(sender + ':' + text)
-
-    def getBadWords(self, filename):
-        #Make sure all the entries are lower case
-        #We lower-case the incoming text to make the check case-insensitive
-        badWords = open(filename)
-        badWordList_strings = set([word.strip().lower() for word in badWords.readlines()])
-        badWords.close()
-        
-        if '' in badWordList_strings:
-            badWordList_strings.remove('')
-        
-        badWordList_regex_strings = []
-
-        for word in badWordList_strings:
-            word = re.sub(r'[sz]', '[s5z2$]', word);
-            word = re.sub(r'a', '[a4]', word);
-            word = re.sub(r'e', '[e3]', word);
-            word = re.sub(r'i', '[i1]', word);
-            word = re.sub(r'l', '[l1]', word);
-            word = re.sub(r'o', '[o0]', word);
-            word = re.sub(r't', '[t7]', word);
-            word = re.sub(r'g', '[g6]', word);
-            word = re.sub(r'b', '[b8]', word);
-            word = re.sub(r'f', '(f|ph)', word);
-            word = re.sub(r'(c|k)', '[ck]', word);
-            badWordList_regex_strings.append(word)
-        
-        badWordList = []
-        
-        for word in badWordList_regex_strings:
-            badWordList.append(re.compile(word))
-        
-        return badWordList
+        now = time.time()
+        if not self.rateLimiter.allow(sender, now):
+            self.naughtyMessage(sender, "rate limited")
+            return
+
+        #Repeats are held back and sent later as one line with a count
+        with self.spamLock:
+            lines = self.spamCollapser.add(sender + ':' + text, now)
+        for line in lines:
+            self.replayQueue.put(line)
 
 
 def main():